@@ -0,0 +1,110 @@
+'''
+插件加载耗时基准：在全新的解释器中导入 main.py，用 -X importtime 统计各依赖的导入耗时，
+并列出加载后已经导入的重量级依赖
+
+用法: python bench/bench_import.py [--runs 5] [--compare <git 版本>]
+'''
+import subprocess
+import argparse
+import statistics
+import tempfile
+import sys
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+HEAVY_MODULES = ('selenium', 'lxml', 'jinja2', 'apscheduler', 'aiohttp', 'PIL')
+PROBE = (
+    "import sys, time\n"
+    "started = time.perf_counter()\n"
+    "import main\n"
+    "print(time.perf_counter() - started)\n"
+    f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+)
+
+
+def parse_importtime(stderr):
+    '''
+    解析 -X importtime 的输出
+    :param stderr: 解释器的标准错误输出
+    :return: {main 直接导入的模块: 累计耗时（微秒）}
+    '''
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # 输出按后序排列，模块名的缩进表示嵌套深度，子模块先于父模块输出
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == "main":
+                return children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    return {}
+
+
+def measure(directory, runs):
+    '''
+    在全新的解释器中多次导入指定目录下的 main.py
+    :param directory: main.py 所在目录
+    :param runs: 次数
+    :return: (导入耗时列表, 最后一次的各模块耗时, 已导入的重量级依赖)
+    '''
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [directory, env.get("PYTHONPATH")]))
+    env.pop("COURSE_TEMPLATE_CACHE_DIR", None)
+    samples = []
+    totals, loaded = {}, []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", PROBE],
+            env=env, cwd=tempfile.gettempdir(), capture_output=True, text=True)
+        if result.returncode != 0:
+            raise SystemExit(f"导入 {directory}/main.py 失败:\n{result.stderr[-2000:]}")
+        elapsed, heavy = result.stdout.split("\n")[-3:-1]
+        samples.append(float(elapsed))
+        totals = parse_importtime(result.stderr)
+        loaded = [name for name in heavy.split(",") if name]
+    return samples, totals, loaded
+
+
+def report(label, directory, runs, top):
+    samples, totals, loaded = measure(directory, runs)
+    print(f"{label}: 导入 main 中位数 {statistics.median(samples) * 1000:.1f}ms "
+          f"(最小 {min(samples) * 1000:.1f}ms, {runs} 次)")
+    print(f"  已导入的重量级依赖: {', '.join(loaded) or '无'}")
+    for name, cumulative in sorted(totals.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {name:<32} {cumulative / 1000:8.1f}ms")
+    return statistics.median(samples)
+
+
+def checkout(revision):
+    '''
+    取出指定版本的 main.py 到临时目录
+    :param revision: git 版本
+    :return: 临时目录
+    '''
+    directory = tempfile.mkdtemp(prefix="course_import_")
+    source = subprocess.run(["git", "show", f"{revision}:main.py"], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    with open(os.path.join(directory, "main.py"), "w", encoding="utf-8") as f:
+        f.write(source)
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="插件加载耗时基准")
+    parser.add_argument("--runs", type=int, default=5, help="每个版本的导入次数")
+    parser.add_argument("--top", type=int, default=8, help="列出耗时最多的前几个模块")
+    parser.add_argument("--compare", help="对照的 git 版本，例如依赖改为首次使用时导入之前的 3d1295d")
+    args = parser.parse_args()
+    current = report("当前版本", REPO_DIR, args.runs, args.top)
+    if args.compare:
+        previous = report(args.compare, checkout(args.compare), args.runs, args.top)
+        print(f"加载耗时减少 {(1 - current / previous) * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+'''
+课表解析微基准：对比逐单元格 XPath 的旧实现与预编译单次遍历的 parse_timetable
+
+用法: python bench/bench_parser.py [fixture.html] [次数]
+'''
+from lxml import html
+import timeit
+import sys
+import os
+import re
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from main import parse_timetable  # noqa: E402
+
+
+def legacy_parse(html_content):
+    '''
+    旧版 CourseFetcher.get_daily_timetable 的解析部分，仅作对照
+    :param html_content: HTML内容
+    :return: 整周课程列表
+    '''
+    parser = html.HTMLParser()
+    root = html.fromstring(html_content, parser=parser)
+
+    color_to_course_type = {
+        'rgb(251, 194, 194)': '必修',
+        'rgb(205, 221, 252)': '限选',
+        'rgb(190, 237, 242)': '任选',
+        'rgb(252, 217, 181)': '公选',
+        'rgb(247, 247, 248)': '其它'
+    }
+
+    time_slot_mapping = {
+        "第一二节": "8:30-10:00",
+        "第三四节": "10:20-11:50",
+        "第五六节": "14:00-15:30",
+        "第七八节": "15:50-17:20",
+        "第九十节": "18:30-20:00"
+    }
+    time_slot_mapping_begin = {
+        "第一二节": "8:00",
+        "第三四节": "9:50",
+        "第五六节": "13:30",
+        "第七八节": "15:20",
+        "第九十节": "18:00"
+    }
+    timetable = []
+    for row in root.xpath('//table[@id="timetable"]/tbody/tr'):
+        if not row.xpath('td[1]/text()'):
+            continue
+        time_slot = row.xpath('td[1]/text()')[0].strip()
+        specific_time = time_slot_mapping.get(time_slot, time_slot)
+        reminder_time = time_slot_mapping_begin.get(time_slot, time_slot)
+        for day_index in range(1, 8):
+            course_td = row.xpath(f'td[{day_index + 1}]')
+            if not course_td or not course_td[0].text_content().strip():
+                continue
+            course_td = course_td[0]
+
+            course_name = course_td.xpath('.//div[@class="item-box"]/p[1]/text()')
+            course_name = course_name[0].strip() if course_name else ''
+            teacher = course_td.xpath('.//div[@class="tch-name"]/span[1]/text()')
+            teacher = teacher[0].strip().replace('教师：', '') if teacher else ''
+            location = course_td.xpath('.//div//span[img/@src="/jsxsd/assets_v1/images/item1.png"]/text()')
+            location = location[0].strip() if location else ''
+
+            color_span = course_td.xpath('.//span[@class="box"]')
+            course_type = ''
+            if color_span:
+                style = color_span[0].get('style', '')
+                color_pattern = r'background-color:\s*rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)'
+                match = re.search(color_pattern, style)
+                if match:
+                    rgb_color = f"rgb({match.group(1)}, {match.group(2)}, {match.group(3)})"
+                    course_type = color_to_course_type.get(rgb_color, '')
+
+            timetable.append({
+                'time_slot': specific_time,
+                'day': day_index,
+                'course_name': course_name,
+                'teacher': teacher,
+                'location': location,
+                'course_type': course_type,
+                'reminder_time': reminder_time,
+            })
+    return timetable
+
+
+def main():
+    fixture = sys.argv[1] if len(sys.argv) > 1 else os.path.join(BENCH_DIR, 'fixtures', 'timetable.html')
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    with open(fixture, 'r', encoding='utf-8') as f:
+        html_content = f.read()
+
+    # 先确认两种实现的解析结果一致
+    legacy = legacy_parse(html_content)
+    compiled = [course._asdict() for course in parse_timetable(html_content)]
+    if legacy != compiled:
+        raise SystemExit("解析结果不一致，基准结果无效")
+
+    legacy_time = min(timeit.repeat(lambda: legacy_parse(html_content), number=number, repeat=5)) / number
+    compiled_time = min(timeit.repeat(lambda: parse_timetable(html_content), number=number, repeat=5)) / number
+    print(f"课程数: {len(compiled)}")
+    print(f"旧实现:   {legacy_time * 1e6:8.1f} us/次")
+    print(f"新实现:   {compiled_time * 1e6:8.1f} us/次")
+    print(f"加速比:   {legacy_time / compiled_time:8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+'''
+离线性能基准：使用录制的课表 HTML 和本地教务系统替身，分别测量解析、渲染和完整的
+send_daily_course 流程，输出吞吐量和 p50/p95/p99，无需访问真实教务系统
+
+用法: python bench/bench_pipeline.py [--users 200] [--latency 0.05] [--backend pillow]
+'''
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+import sys
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import main as plugin_module  # noqa: E402
+from mock_server import MockAcademicServer, LOGIN_PATH, TIMETABLE_PATH, load_fixtures  # noqa: E402
+
+
+def percentile(samples, q):
+    '''
+    最近秩法计算分位数
+    :param samples: 已排序的样本
+    :param q: 分位，0-1
+    :return: 分位数
+    '''
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples) - 1, int(round(q * len(samples) + 0.5)) - 1))
+    return samples[index]
+
+
+def report(name, samples, wall):
+    '''
+    输出一组测量结果
+    :param name: 名称
+    :param samples: 每次操作的耗时（秒）
+    :param wall: 总耗时（秒）
+    '''
+    samples = sorted(samples)
+    throughput = len(samples) / wall if wall else 0
+    print(f"{name:<24} n={len(samples):<6} 吞吐 {throughput:9.1f}/s  "
+          f"p50 {percentile(samples, 0.5) * 1000:8.2f}ms  "
+          f"p95 {percentile(samples, 0.95) * 1000:8.2f}ms  "
+          f"p99 {percentile(samples, 0.99) * 1000:8.2f}ms")
+
+
+class StubContext:
+    '''
+    替代 AstrBot 的 Context，只记录发送次数，可模拟平台延迟
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, umo, message_chain):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+def bench_parse(iterations):
+    '''
+    测量课表解析
+    :param iterations: 每份课表的解析次数
+    '''
+    fixtures = load_fixtures()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for html_content in fixtures:
+            t = time.perf_counter()
+            plugin_module.parse_timetable(html_content)
+            samples.append(time.perf_counter() - t)
+    report("parse", samples, time.perf_counter() - started)
+
+
+async def bench_render(backend, iterations):
+    '''
+    测量课表图片渲染，不经过图片缓存
+    :param backend: 渲染后端名称
+    :param iterations: 渲染次数
+    '''
+    fetcher = plugin_module.CourseFetcher("bench", "bench", render_backend=backend)
+    week = plugin_module.WeekTimetable(1, plugin_module.parse_timetable(load_fixtures()[0]))
+    days = [day for day in week.days() if week.on_day(day)]
+    samples = []
+    started = time.perf_counter()
+    try:
+        for i in range(iterations):
+            t = time.perf_counter()
+            await fetcher.generate_schedule_image(week.on_day(days[i % len(days)]), i)
+            samples.append(time.perf_counter() - t)
+    finally:
+        fetcher.browser_pool.shutdown()
+    report(f"render[{fetcher.render_backend.name}]", samples, time.perf_counter() - started)
+
+
+async def bench_daily(users, latency, send_latency, backend, render_cache, port, upstream_rate=None, mode='image',
+                      send_rate=None):
+    '''
+    对 N 个模拟用户执行完整的 send_daily_course 流程
+    :param users: 用户数
+    :param latency: 教务系统接口延迟（秒）
+    :param send_latency: 消息发送延迟（秒）
+    :param backend: 渲染后端名称
+    :param render_cache: 是否启用图片缓存
+    :param port: 教务系统替身端口
+    :param upstream_rate: 覆盖插件的上游限速（次/秒），默认沿用插件配置
+    :param mode: 推送模式 image / text / both
+    :param send_rate: 覆盖出站队列的默认发送速率（条/秒），默认沿用插件配置
+    '''
+    server = MockAcademicServer(latency=latency)
+    base_url = await server.start(port=port)
+    fetcher_class = plugin_module.CourseFetcher
+    fetcher_class.LOGIN_URL = base_url + LOGIN_PATH
+    fetcher_class.TIMETABLE_URL_FORMAT = base_url + TIMETABLE_PATH + "?rq={date}&sjmsValue={sjms}&xnxqid={xnxqid}"
+    fetcher_class.HEADERS = {k: v for k, v in fetcher_class.HEADERS.items() if k not in ('Host', 'Origin', 'Referer')}
+
+    if upstream_rate:
+        plugin_module.CourseQueryPlugin.UPSTREAM_RATE = upstream_rate
+        plugin_module.CourseQueryPlugin.UPSTREAM_BURST = max(plugin_module.CourseQueryPlugin.UPSTREAM_BURST, int(upstream_rate))
+
+    if send_rate:
+        plugin_module.CourseQueryPlugin.DELIVERY_DEFAULT_RATE = send_rate
+
+    context = StubContext(send_latency)
+    plugin = plugin_module.CourseQueryPlugin(context)
+    plugin.RENDER_BACKEND = backend
+    if not render_cache:
+        plugin.render_cache = None
+    plugin.user = {
+        f"bench{i}": {'platform': 'bench', 'umo': f"bench:FriendMessage:{i}", 'user': f"2023{i:05d}",
+                      'password': 'bench', 'status': '1', 'mode': mode}
+        for i in range(users)
+    }
+
+    samples = []
+    send_one = plugin.send_daily_course_to_user
+
+    async def timed(user_id, user_info, limits):
+        t = time.perf_counter()
+        await send_one(user_id, user_info, limits)
+        samples.append(time.perf_counter() - t)
+
+    plugin.send_daily_course_to_user = timed
+    started = time.perf_counter()
+    try:
+        await plugin.send_daily_course()
+        wall = time.perf_counter() - started
+    finally:
+        await plugin.delivery_queue.close()
+        await plugin.session_manager.close()
+        plugin.browser_pool.shutdown()
+        plugin.user_store.close()
+        await server.stop()
+    report(f"send_daily_course[{users}]", samples, wall)
+    print(f"{'':<24} 登录 {server.login_count} 次，课表请求 {server.timetable_count} 次，发送 {context.sent} 条，"
+          f"总耗时 {wall:.2f}s")
+
+
+async def run(args):
+    bench_parse(args.iterations)
+    await bench_render(args.backend, args.render_iterations)
+    await bench_daily(args.users, args.latency, args.send_latency, args.backend, args.render_cache, args.port,
+                      args.upstream_rate, args.mode, args.send_rate)
+    print()
+    print(plugin_module.metrics.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="课表插件离线性能基准")
+    parser.add_argument('--users', type=int, default=200, help="模拟用户数")
+    parser.add_argument('--latency', type=float, default=0.05, help="教务系统接口延迟（秒）")
+    parser.add_argument('--send-latency', type=float, default=0.01, help="消息发送延迟（秒）")
+    parser.add_argument('--backend', default='pillow', help="渲染后端: selenium / pillow / auto")
+    parser.add_argument('--mode', default='image', choices=('image', 'text', 'both'), help="推送模式")
+    parser.add_argument('--render-cache', action='store_true', help="启用图片缓存")
+    parser.add_argument('--iterations', type=int, default=200, help="每份课表的解析次数")
+    parser.add_argument('--render-iterations', type=int, default=20, help="渲染次数")
+    parser.add_argument('--upstream-rate', type=float, default=None, help="覆盖上游限速（次/秒），用于测量插件自身上限")
+    parser.add_argument('--send-rate', type=float, default=None, help="覆盖出站队列的默认发送速率（条/秒）")
+    parser.add_argument('--port', type=int, default=8765, help="教务系统替身端口")
+    args = parser.parse_args()
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    # 插件会在当前目录创建数据库和缓存，放到临时目录中避免影响真实数据
+    os.chdir(tempfile.mkdtemp(prefix="course_bench_"))
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
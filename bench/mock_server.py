@@ -0,0 +1,113 @@
+'''
+教务系统的本地替身，提供 LoginToXk 和 mainV_index_loadkb.htmlx 两个接口，可配置延迟
+
+用法: python bench/mock_server.py [--port 8765] [--latency 0.05]
+'''
+from aiohttp import web
+import argparse
+import asyncio
+import zlib
+import os
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+LOGIN_PATH = '/jsxsd/xk/LoginToXk'
+TIMETABLE_PATH = '/jsxsd/framework/mainV_index_loadkb.htmlx'
+
+
+def load_fixtures(fixture_dir=FIXTURE_DIR):
+    '''
+    读取录制的课表 HTML
+    :param fixture_dir: 目录
+    :return: HTML 列表，按文件名排序
+    '''
+    fixtures = []
+    for name in sorted(os.listdir(fixture_dir)):
+        if name.endswith('.html'):
+            with open(os.path.join(fixture_dir, name), 'r', encoding='utf-8') as f:
+                fixtures.append(f.read())
+    return fixtures
+
+
+class MockAcademicServer:
+    '''
+    模拟教务系统：登录后下发 Cookie，未登录访问课表时重定向回登录页，
+    每个账号固定返回其中一份课表
+    '''
+    def __init__(self, fixtures=None, latency=0.05, login_latency=None, passwords=None):
+        '''
+           初始化
+           :param fixtures: 课表 HTML 列表
+           :param latency: 课表接口延迟（秒）
+           :param login_latency: 登录接口延迟（秒），默认与课表接口相同
+           :param passwords: {账号: 密码}，指定后密码错误的登录不下发 Cookie，默认任意密码都能登录
+        '''
+        self.fixtures = fixtures or load_fixtures()
+        self.latency = latency
+        self.login_latency = latency if login_latency is None else login_latency
+        self.passwords = passwords
+        self.sessions = {}
+        self.login_count = 0
+        self.timetable_count = 0
+        self._runner = None
+
+    def fixture_for(self, account):
+        return self.fixtures[zlib.crc32(account.encode('utf-8')) % len(self.fixtures)]
+
+    async def login(self, request):
+        await asyncio.sleep(self.login_latency)
+        form = await request.post()
+        self.login_count += 1
+        account = form.get('userAccount', '')
+        if self.passwords is not None and self.passwords.get(account) != form.get('userPassword'):
+            return web.Response(text="用户名或密码错误")
+        token = f"{form.get('userAccount', '')}-{self.login_count}"
+        self.sessions[token] = form.get('userAccount', '')
+        response = web.Response(text="ok")
+        response.set_cookie("JSESSIONID", token)
+        return response
+
+    async def login_page(self, request):
+        return web.Response(text="<form action=\"LoginToXk\"></form>")
+
+    async def timetable(self, request):
+        await asyncio.sleep(self.latency)
+        account = self.sessions.get(request.cookies.get("JSESSIONID", ""))
+        if account is None:
+            raise web.HTTPFound(LOGIN_PATH)
+        self.timetable_count += 1
+        return web.Response(text=self.fixture_for(account), content_type='text/html')
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(LOGIN_PATH, self.login)
+        app.router.add_get(LOGIN_PATH, self.login_page)
+        app.router.add_get(TIMETABLE_PATH, self.timetable)
+        return app
+
+    async def start(self, host='localhost', port=8765):
+        '''
+        启动服务
+        :return: 服务根地址
+        '''
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="教务系统本地替身")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    web.run_app(MockAcademicServer(latency=args.latency).app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
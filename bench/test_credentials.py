@@ -0,0 +1,108 @@
+'''
+凭据隔离回归测试：错误的密码不能通过会话、课表缓存或过期兜底缓存拿到他人的课表
+
+用法: python -m pytest bench/test_credentials.py 或 python bench/test_credentials.py
+'''
+import asyncio
+import tempfile
+import sys
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import main as plugin_module  # noqa: E402
+from mock_server import MockAcademicServer, LOGIN_PATH, TIMETABLE_PATH  # noqa: E402
+
+ACCOUNT = "20230001"
+PASSWORD = "right"
+PORT = 8766
+
+
+class Upstream:
+    '''
+    启动要求正确密码的教务系统替身，并把 CourseFetcher 指向它
+    '''
+    def __init__(self):
+        self.server = MockAcademicServer(latency=0.01, passwords={ACCOUNT: PASSWORD})
+        self.session_manager = plugin_module.SessionManager(rate=100, burst=100, retries=0)
+        self.timetable_cache = plugin_module.TimetableCache(path=None)
+
+    async def __aenter__(self):
+        base_url = await self.server.start(port=PORT)
+        fetcher_class = plugin_module.CourseFetcher
+        fetcher_class.LOGIN_URL = base_url + LOGIN_PATH
+        fetcher_class.TIMETABLE_URL_FORMAT = base_url + TIMETABLE_PATH + "?rq={date}&sjmsValue={sjms}&xnxqid={xnxqid}"
+        fetcher_class.HEADERS = {k: v for k, v in fetcher_class.HEADERS.items() if k not in ('Host', 'Origin', 'Referer')}
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session_manager.close()
+        await self.server.stop()
+
+    def fetcher(self, password):
+        return plugin_module.CourseFetcher(
+            ACCOUNT, password,
+            session_manager=self.session_manager,
+            timetable_cache=self.timetable_cache,
+            single_flight=plugin_module.SingleFlight(),
+        )
+
+
+async def expect_failure(coro, exceptions):
+    try:
+        await coro
+    except exceptions:
+        return
+    raise AssertionError("错误的密码拿到了课表")
+
+
+def test_wrong_password_misses_warm_cache():
+    async def run():
+        async with Upstream() as upstream:
+            await upstream.fetcher(PASSWORD).get_courses()
+            await expect_failure(upstream.fetcher("WRONG").get_courses(), plugin_module.LoginFailed)
+    asyncio.run(run())
+
+
+def test_wrong_password_gets_no_stale_fallback():
+    async def run():
+        async with Upstream() as upstream:
+            await upstream.fetcher(PASSWORD).get_courses()
+            await upstream.server.stop()
+            await expect_failure(upstream.fetcher("WRONG").get_courses(force_refresh=True),
+                                 (plugin_module.LoginFailed, plugin_module.UpstreamError))
+    asyncio.run(run())
+
+
+def test_wrong_password_does_not_reuse_owner_session():
+    async def run():
+        async with Upstream() as upstream:
+            wrong, owner = upstream.fetcher("WRONG"), upstream.fetcher(PASSWORD)
+            results = await asyncio.gather(
+                wrong.get_courses(force_refresh=True), owner.get_courses(force_refresh=True),
+                return_exceptions=True)
+            assert isinstance(results[0], plugin_module.LoginFailed), results[0]
+            assert not isinstance(results[1], BaseException), results[1]
+    asyncio.run(run())
+
+
+def test_failed_login_closes_session():
+    async def run():
+        async with Upstream() as upstream:
+            await upstream.fetcher(PASSWORD).get_courses()
+            await expect_failure(upstream.fetcher("WRONG").get_courses(), plugin_module.LoginFailed)
+            assert len(upstream.session_manager._sessions) == 1
+            await upstream.session_manager.discard(ACCOUNT, PASSWORD)
+            assert not upstream.session_manager._sessions
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    # 插件会在当前目录创建数据文件，放到临时目录中避免影响真实数据
+    os.chdir(tempfile.mkdtemp(prefix="course_test_"))
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,96 @@
+'''
+请求合并回归测试：同键的并发调用只执行一次，某个调用者超时或被取消不影响其他调用者
+
+用法: python -m pytest bench/test_single_flight.py 或 python bench/test_single_flight.py
+'''
+import asyncio
+import sys
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from main import SingleFlight  # noqa: E402
+
+
+def counting(delay, result="ok", error=None):
+    '''
+    生成记录调用次数的协程函数
+    :param delay: 执行耗时（秒）
+    :param result: 返回值
+    :param error: 要抛出的异常
+    :return: (协程函数, 调用次数列表)
+    '''
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+    return func, calls
+
+
+def test_concurrent_calls_share_one_execution():
+    async def run():
+        flight = SingleFlight()
+        func, calls = counting(0.05)
+        results = await asyncio.gather(*[flight.do("key", func) for _ in range(10)])
+        assert results == ["ok"] * 10
+        assert len(calls) == 1
+        assert flight.shared == 9
+    asyncio.run(run())
+
+
+def test_leader_timeout_does_not_cancel_followers():
+    async def run():
+        flight = SingleFlight()
+        func, calls = counting(0.3)
+        leader = asyncio.ensure_future(asyncio.wait_for(flight.do("key", func), 0.1))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(asyncio.wait_for(flight.do("key", func), 10))
+        try:
+            await leader
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("领头调用应当超时")
+        assert await follower == "ok"
+        assert len(calls) == 1
+    asyncio.run(run())
+
+
+def test_follower_cancel_does_not_cancel_leader():
+    async def run():
+        flight = SingleFlight()
+        func, calls = counting(0.1)
+        leader = asyncio.ensure_future(flight.do("key", func))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("key", func))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        assert await leader == "ok"
+        assert follower.cancelled()
+    asyncio.run(run())
+
+
+def test_errors_reach_every_caller_and_key_is_released():
+    async def run():
+        flight = SingleFlight()
+        func, calls = counting(0.05, error=ValueError("upstream"))
+        results = await asyncio.gather(*[flight.do("key", func) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(calls) == 1
+        # 失败后不缓存结果，下一次调用重新执行
+        func, calls = counting(0)
+        assert await flight.do("key", func) == "ok"
+        assert len(calls) == 1
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -1,55 +1,1289 @@
-from astrbot.api.event import filter, AstrMessageEvent, MessageChain, MessageEventResult
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from astrbot.api.event import filter, AstrMessageEvent, MessageChain
 from astrbot.api.star import Context, Star, register
-from selenium.webdriver.edge.options import Options
-from selenium.webdriver.edge.service import Service
-from apscheduler.triggers.cron import CronTrigger
-from astrbot.api.message_components import Plain
-from jinja2 import Environment, BaseLoader
-from datetime import datetime
+from astrbot.api.message_components import Plain, Image
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from functools import lru_cache
+from typing import NamedTuple
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta
 from astrbot.api import logger
-from selenium import webdriver
-from lxml import html
 import configparser
-import tempfile
+import sqlite3
+import threading
+import queue
 import asyncio
-import aiohttp
+import hashlib
+import io
+import bisect
 import base64
+import random
+import json
+import time
 import re
 import os
-class CourseFetcher:
+class Metrics:
     '''
-    课程处理类负责与教务系统进行交互
+    各阶段的耗时直方图、调用次数和错误次数，线程安全，可输出摘要或 Prometheus 文本格式
     '''
-    # 教务系统登录URL
-    LOGIN_URL = "https://qzjwpc.cqvtu.edu.cn/jsxsd/xk/LoginToXk"
-    # 课程表URL格式
-    TIMETABLE_URL_FORMAT = "https://qzjwpc.cqvtu.edu.cn/jsxsd/framework/mainV_index_loadkb.htmlx?rq={date}&sjmsValue=7BF92DA627F746F59D245A65B31BCE86&xnxqid=2024-2025-2&xswk=false"
-    def __init__(self, username, password, start_date_str):
+    # 直方图桶上界（秒）
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+    def observe(self, stage, seconds, error=False):
+        '''
+        记录一次阶段耗时
+        :param stage: 阶段名称
+        :param seconds: 耗时（秒）
+        :param error: 是否出错
+        '''
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                data = self._stages[stage] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'count': 0, 'sum': 0.0, 'errors': 0}
+            data['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            data['count'] += 1
+            data['sum'] += seconds
+            if error:
+                data['errors'] += 1
+    @contextmanager
+    def stage(self, stage):
+        '''
+        统计代码块耗时，抛出异常时计为错误
+        :param stage: 阶段名称
+        '''
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(stage, time.perf_counter() - started, error=True)
+            raise
+        else:
+            self.observe(stage, time.perf_counter() - started)
+    def _quantile(self, data, q):
+        '''
+        按直方图估算分位数，返回所在桶的上界
+        '''
+        target = q * data['count']
+        seen = 0
+        for index, count in enumerate(data['buckets']):
+            seen += count
+            if seen >= target and count:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else float('inf')
+        return 0.0
+    def summary(self):
+        '''
+        生成可读的摘要
+        :return: 文本
+        '''
+        with self._lock:
+            lines = []
+            for stage, data in sorted(self._stages.items()):
+                average = data['sum'] / data['count'] * 1000 if data['count'] else 0
+                lines.append(
+                    f"{stage}: 次数 {data['count']} 错误 {data['errors']} 平均 {average:.0f}ms "
+                    f"p50≤{self._quantile(data, 0.5) * 1000:.0f}ms p95≤{self._quantile(data, 0.95) * 1000:.0f}ms "
+                    f"p99≤{self._quantile(data, 0.99) * 1000:.0f}ms")
+            return "\n".join(lines) or "暂无统计数据"
+    def prometheus(self):
+        '''
+        生成 Prometheus 文本格式
+        :return: 文本
+        '''
+        with self._lock:
+            lines = [
+                "# HELP course_stage_duration_seconds 课表插件各阶段耗时",
+                "# TYPE course_stage_duration_seconds histogram",
+            ]
+            for stage, data in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + (float('inf'),), data['buckets']):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                    lines.append(f'course_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'course_stage_duration_seconds_sum{{stage="{stage}"}} {data["sum"]:.6f}')
+                lines.append(f'course_stage_duration_seconds_count{{stage="{stage}"}} {data["count"]}')
+            lines.append("# HELP course_stage_errors_total 课表插件各阶段错误次数")
+            lines.append("# TYPE course_stage_errors_total counter")
+            for stage, data in sorted(self._stages.items()):
+                lines.append(f'course_stage_errors_total{{stage="{stage}"}} {data["errors"]}')
+            return "\n".join(lines) + "\n"
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+# 进程内共享的性能统计
+metrics = Metrics()
+class Course(NamedTuple):
+    '''
+    单节课程
+    '''
+    day: int
+    time_slot: str
+    reminder_time: str
+    course_name: str
+    teacher: str
+    location: str
+    course_type: str
+    @property
+    def reminder(self):
+        return f"提醒:\n{self.time_slot}\n请准备前往 {self.location},即将开始 {self.course_name} ({self.teacher}老师)的课程。"
+# 课表解析用到的 XPath、正则和映射表只在模块加载时编译一次
+TIMETABLE_ROWS_XPATH = '//table[@id="timetable"]/tbody/tr'
+COLOR_PATTERN = re.compile(r'background-color:\s*rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)')
+SLOT_START_PATTERN = re.compile(r'\s*(\d{1,2}):(\d{2})')
+LOCATION_ICON = "/jsxsd/assets_v1/images/item1.png"
+COLOR_TO_COURSE_TYPE = {
+    ('251', '194', '194'): '必修',
+    ('205', '221', '252'): '限选',
+    ('190', '237', '242'): '任选',
+    ('252', '217', '181'): '公选',
+    ('247', '247', '248'): '其它'
+}
+class SlotTable:
+    '''
+    作息时间表：教务系统的节次名称到上课时间、提醒时间的映射，构造时一次建好查找表
+    '''
+    def __init__(self, name, slots):
         '''
            初始化
-           :param username: 用户名
-           :param password: 密码
-           :param start_date_str: 开始日期字符串
+           :param name: 名称
+           :param slots: [(节次名称, 上课时间, 提醒时间)]，按上课先后排列
         '''
-        self.username = username
-        self.password = password
-        self.start_date_str = start_date_str
-        self.edge_options = Options()
-        self.edge_options.add_argument("--headless")  # 无头模式
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.driver_path = os.path.join(script_dir, "msedgedriver.exe")
-        self.num_map = {
-            0: '零',
-            1: '一',
-            2: '二',
-            3: '三',
-            4: '四',
-            5: '五',
-            6: '六',
-            7: '七',
+        self.name = name
+        self._lookup = {label: (time_slot, reminder_time) for label, time_slot, reminder_time in slots}
+        self.time_slots = tuple(time_slot for _, time_slot, _ in slots)
+    def lookup(self, label):
+        '''
+        查找节次的上课时间和提醒时间
+        :param label: 节次名称，如 "第一二节"
+        :return: (上课时间, 提醒时间)，未知节次原样返回
+        '''
+        return self._lookup.get(label, (label, label))
+# 内置的学期配置，找不到或无法解析 terms.json 时使用，格式与 terms.json 相同
+DEFAULT_TERMS_CONFIG = {
+    "default_campus": "主校区",
+    "slot_tables": {
+        "默认作息": [
+            {"label": "第一二节", "time": "8:30-10:00", "reminder": "8:00"},
+            {"label": "第三四节", "time": "10:20-11:50", "reminder": "9:50"},
+            {"label": "第五六节", "time": "14:00-15:30", "reminder": "13:30"},
+            {"label": "第七八节", "time": "15:50-17:20", "reminder": "15:20"},
+            {"label": "第九十节", "time": "18:30-20:00", "reminder": "18:00"},
+        ],
+    },
+    "campuses": {
+        "主校区": {"sjmsValue": "7BF92DA627F746F59D245A65B31BCE86", "slot_table": "默认作息"},
+    },
+    "terms": [
+        {"xnxqid": "2024-2025-2", "start": "2025-02-17", "weeks": 20},
+    ],
+}
+DEFAULT_SLOT_TABLE = SlotTable("默认作息", [
+    (slot["label"], slot["time"], slot["reminder"]) for slot in DEFAULT_TERMS_CONFIG["slot_tables"]["默认作息"]])
+def _first_text(element):
+    '''
+    取元素下第一个文本节点，等价于 XPath 的 text()[1]
+    :param element: lxml 元素
+    :return: 文本，没有文本节点时返回 None
+    '''
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return None
+def _parse_course_cell(td, day, time_slot, reminder_time):
+    '''
+    单次遍历课表单元格，提取课程信息
+    :param td: 单元格元素
+    :param day: 星期几
+    :param time_slot: 上课时间
+    :param reminder_time: 提醒时间
+    :return: Course，空单元格返回 None
+    '''
+    has_text = bool(td.text and td.text.strip())
+    course_name = teacher = location = course_type = None
+    for element in td.iterdescendants():
+        if not has_text and ((element.text and element.text.strip()) or (element.tail and element.tail.strip())):
+            has_text = True
+        tag = element.tag
+        if tag == 'div':
+            css_class = element.get('class')
+            if css_class == 'item-box' and course_name is None:
+                for child in element:
+                    if child.tag == 'p':
+                        course_name = _first_text(child)
+                        break
+            elif css_class == 'tch-name' and teacher is None:
+                for child in element:
+                    if child.tag == 'span':
+                        teacher = _first_text(child)
+                        break
+        elif tag == 'span':
+            if element.get('class') == 'box':
+                if course_type is None:
+                    match = COLOR_PATTERN.search(element.get('style', ''))
+                    course_type = COLOR_TO_COURSE_TYPE.get(match.groups(), '') if match else ''
+            elif location is None:
+                for child in element:
+                    if child.tag == 'img' and child.get('src') == LOCATION_ICON:
+                        location = _first_text(element)
+                        break
+    if not has_text:
+        return None
+    return Course(
+        day=day,
+        time_slot=time_slot,
+        reminder_time=reminder_time,
+        course_name=course_name.strip() if course_name else '',
+        teacher=teacher.strip().replace('教师：', '') if teacher else '',
+        location=location.strip() if location else '',
+        course_type=course_type or '',
+    )
+@lru_cache(maxsize=None)
+def timetable_rows_xpath():
+    '''
+    预编译的课表行 XPath，首次解析时才导入 lxml 并编译
+    :return: etree.XPath
+    '''
+    from lxml import etree
+    return etree.XPath(TIMETABLE_ROWS_XPATH)
+def parse_timetable(html_content, slot_table=None):
+    '''
+    解析整周课表
+    :param html_content: HTML内容
+    :param slot_table: 作息时间表，默认使用内置作息
+    :return: 整周课程，Course 元组
+    '''
+    from lxml import html
+    slot_table = slot_table or DEFAULT_SLOT_TABLE
+    root = html.fromstring(html_content)
+    timetable = []
+    for row in timetable_rows_xpath()(root):
+        cells = [child for child in row if child.tag == 'td']
+        if not cells:
+            continue
+        time_slot = _first_text(cells[0])
+        if time_slot is None:
+            continue
+        specific_time, reminder_time = slot_table.lookup(time_slot.strip())
+        for day_index, course_td in enumerate(cells[1:8], start=1):
+            course = _parse_course_cell(course_td, day_index, specific_time, reminder_time)
+            if course is not None:
+                timetable.append(course)
+    return tuple(timetable)
+class WeekTimetable:
+    '''
+    一次解析得到的整周课表，可直接回答某天的课程、某时刻之后的下一节课和空闲时段
+    '''
+    def __init__(self, weeks, courses, slot_table=None):
+        '''
+           初始化
+           :param weeks: 教学周
+           :param courses: 整周课程，Course 元组
+           :param slot_table: 作息时间表，默认使用内置作息
+        '''
+        self.weeks = weeks
+        self.courses = tuple(courses)
+        self.slot_table = slot_table or DEFAULT_SLOT_TABLE
+        self._by_day = {}
+        for course in sorted(self.courses, key=lambda c: (c.day, _slot_start_minutes(c.time_slot))):
+            self._by_day.setdefault(course.day, []).append(course)
+    def on_day(self, day):
+        '''
+        某天的课程，按上课时间排序
+        :param day: 星期几（1-7）
+        :return: 课程列表
+        '''
+        return list(self._by_day.get(day, ()))
+    def next_course(self, day, after):
+        '''
+        某天某时刻之后的下一节课
+        :param day: 星期几（1-7）
+        :param after: datetime.time
+        :return: Course，没有时返回 None
+        '''
+        minutes = after.hour * 60 + after.minute
+        for course in self._by_day.get(day, ()):
+            if _slot_start_minutes(course.time_slot) >= minutes:
+                return course
+        return None
+    def free_slots(self, day):
+        '''
+        某天没有课的时段
+        :param day: 星期几（1-7）
+        :return: 时段列表，如 ["14:00-15:30"]
+        '''
+        busy = {course.time_slot for course in self._by_day.get(day, ())}
+        return [slot for slot in self.slot_table.time_slots if slot not in busy]
+    def days(self):
+        '''
+        有课的日期
+        :return: 星期几列表
+        '''
+        return sorted(self._by_day)
+def _slot_start_minutes(time_slot):
+    '''
+    将 "8:30-10:00" 形式的时段转换为开始时间的分钟数，无法识别时排在最后
+    :param time_slot: 时段字符串
+    :return: 分钟数
+    '''
+    match = SLOT_START_PATTERN.match(time_slot)
+    if not match:
+        return 24 * 60
+    return int(match.group(1)) * 60 + int(match.group(2))
+WEEKDAY_NAMES = ('', '周一', '周二', '周三', '周四', '周五', '周六', '周日')
+# 变动检测只比较会影响上课的字段
+COURSE_DIFF_FIELDS = (('course_name', '课程'), ('teacher', '教师'), ('location', '地点'), ('course_type', '类型'))
+class TimetableSnapshot(NamedTuple):
+    '''
+    上一次检测到的整周课表，用于变动检测
+    '''
+    term: str
+    week: int
+    digest: str
+    courses: tuple
+    checked_at: float
+    interval: float
+def timetable_digest(courses):
+    '''
+    整周课表的内容哈希，与课程顺序无关
+    :param courses: Course 列表
+    :return: 十六进制摘要
+    '''
+    payload = json.dumps(sorted(list(course) for course in courses), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+def diff_courses(old, new, since_day=1):
+    '''
+    比较两份整周课表，按 (星期, 时段) 对齐，生成精简的变动说明
+    :param old: 旧课表
+    :param new: 新课表
+    :param since_day: 只报告星期几及以后的变动，已经过去的日子不再提示
+    :return: 变动说明列表，没有变动时为空
+    '''
+    old_slots, new_slots = {}, {}
+    for course in old:
+        old_slots.setdefault((course.day, course.time_slot), []).append(course)
+    for course in new:
+        new_slots.setdefault((course.day, course.time_slot), []).append(course)
+    changes = []
+    for key in sorted(old_slots.keys() | new_slots.keys(), key=lambda k: (k[0], _slot_start_minutes(k[1]))):
+        day, time_slot = key
+        if day < since_day:
+            continue
+        before, after = old_slots.get(key, []), new_slots.get(key, [])
+        prefix = f"{WEEKDAY_NAMES[day]} {time_slot}"
+        if len(before) == 1 and len(after) == 1:
+            fields = [f"{label} {getattr(before[0], name) or '无'} → {getattr(after[0], name) or '无'}"
+                      for name, label in COURSE_DIFF_FIELDS if getattr(before[0], name) != getattr(after[0], name)]
+            if fields:
+                changes.append(f"{prefix} {before[0].course_name}：{'，'.join(fields)}")
+            continue
+        for course in before:
+            if course not in after:
+                changes.append(f"{prefix} 取消：{course.course_name}")
+        for course in after:
+            if course not in before:
+                changes.append(f"{prefix} 新增：{course.course_name}（{course.teacher}，{course.location}）")
+    return changes
+class TermCalendar:
+    '''
+    某个校区的一个学期：学年学期号、时间模式、作息时间和开学日期，周次按日期序数直接计算
+    '''
+    def __init__(self, xnxqid, campus, sjms_value, start_date, weeks, slot_table):
+        '''
+           初始化
+           :param xnxqid: 学年学期号，如 2024-2025-2
+           :param campus: 校区名称
+           :param sjms_value: 教务系统的时间模式（sjmsValue）
+           :param start_date: 开学日期（第一周周一）
+           :param weeks: 教学周数
+           :param slot_table: 作息时间表
+        '''
+        self.xnxqid = xnxqid
+        self.campus = campus
+        self.sjms_value = sjms_value
+        self.start_date = start_date
+        self.weeks = weeks
+        self.slot_table = slot_table
+        self.end_date = start_date + timedelta(days=7 * weeks - 1)
+        # 作为课表缓存和请求合并的键，换学期或校区后不会误用旧课表
+        self.key = f"{xnxqid}@{campus}"
+        self._start_ordinal = start_date.toordinal()
+    def week(self, date):
+        '''
+        计算教学周
+        :param date: 日期
+        :return: 周数
+        '''
+        return (date.toordinal() - self._start_ordinal) // 7 + 1
+class TermRegistry:
+    '''
+    学期日历注册表，启动时从 terms.json 加载一次，按日期自动选择所在学期，
+    新学期开学当天自动切换；文件修改后可调用 reload_if_changed 重新加载
+    '''
+    def __init__(self, path=None):
+        '''
+           初始化
+           :param path: terms.json 路径，为空或不存在时使用内置配置
+        '''
+        self.path = path
+        self.default_campus = None
+        self._mtime = None
+        self._by_campus = {}
+        self._warned = set()
+        self.load()
+    def load(self):
+        '''
+        加载配置，文件有误时保留已加载的配置，首次加载失败则使用内置配置
+        '''
+        config, mtime = DEFAULT_TERMS_CONFIG, None
+        if self.path and os.path.exists(self.path):
+            try:
+                mtime = os.path.getmtime(self.path)
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+                self.apply(config)
+                self._mtime = mtime
+                logger.info(f"从 {self.path} 加载学期配置，共 {self.term_count()} 个学期日历")
+                return
+            except Exception as e:
+                logger.error(f"加载学期配置 {self.path} 失败: {e!r}")
+                if self._by_campus:
+                    self._mtime = mtime
+                    return
+                config = DEFAULT_TERMS_CONFIG
+        self.apply(config)
+        self._mtime = mtime
+    def apply(self, config):
+        '''
+        根据配置预先建好各校区的学期列表，全部解析成功后才替换当前配置
+        :param config: 与 terms.json 相同格式的字典
+        '''
+        slot_tables = {
+            name: SlotTable(name, [(slot["label"], slot["time"], slot["reminder"]) for slot in slots])
+            for name, slots in config["slot_tables"].items()
         }
-        self.TMPL = """<!DOCTYPE html>
+        campuses = config["campuses"]
+        by_campus = {campus: [] for campus in campuses}
+        for term in config["terms"]:
+            start_date = datetime.strptime(term["start"], '%Y-%m-%d').date()
+            overrides = term.get("campuses", {})
+            for campus, settings in campuses.items():
+                # 学期中可按校区覆盖时间模式和作息
+                settings = {**settings, **overrides.get(campus, {})}
+                by_campus[campus].append(TermCalendar(
+                    term["xnxqid"], campus, settings["sjmsValue"], start_date, term.get("weeks", 20),
+                    slot_tables[settings["slot_table"]]))
+        index = {}
+        for campus, terms in by_campus.items():
+            if not terms:
+                raise ValueError(f"校区 {campus} 没有配置学期")
+            terms.sort(key=lambda term: term.start_date)
+            index[campus] = ([term.start_date.toordinal() for term in terms], terms)
+        default_campus = config.get("default_campus") or next(iter(campuses))
+        if default_campus not in index:
+            raise ValueError(f"默认校区 {default_campus} 不存在")
+        self._by_campus = index
+        self.default_campus = default_campus
+    def reload_if_changed(self):
+        '''
+        terms.json 修改后重新加载
+        :return: 是否重新加载
+        '''
+        if not self.path:
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self.load()
+        return True
+    def campuses(self):
+        '''
+        所有校区
+        :return: 校区名称列表
+        '''
+        return list(self._by_campus)
+    def term_count(self):
+        return sum(len(terms) for _, terms in self._by_campus.values())
+    def term_for(self, date=None, campus=None):
+        '''
+        查找日期所在的学期，假期中返回最近开始的学期，第一个学期开学前返回第一个学期
+        :param date: 日期，默认今天
+        :param campus: 校区，未知时使用默认校区
+        :return: TermCalendar
+        '''
+        date = date or datetime.now().date()
+        starts, terms = self._by_campus.get(campus) or self._by_campus[self.default_campus]
+        term = terms[max(bisect.bisect_right(starts, date.toordinal()) - 1, 0)]
+        if date > term.end_date and term.key not in self._warned:
+            self._warned.add(term.key)
+            logger.warning(f"学期 {term.key} 已于 {term.end_date} 结束，请在学期配置中添加新学期")
+        return term
+class BrowserPool:
+    '''
+    无头浏览器池，常驻若干个 Edge 实例供截图复用，避免每次渲染都重新启动浏览器
+    '''
+    def __init__(self, driver_path, options=None, size=2, max_renders=50, window_size=(800, 700)):
+        '''
+           初始化
+           :param driver_path: msedgedriver 路径
+           :param options: Edge 启动参数，为空时在首次启动浏览器时使用默认参数
+           :param size: 池中浏览器实例的最大数量
+           :param max_renders: 单个实例渲染多少次后回收重建
+           :param window_size: 浏览器窗口大小
+        '''
+        self.driver_path = driver_path
+        self.options = options
+        self.size = size
+        self.max_renders = max_renders
+        self.window_size = window_size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._render_counts = {}
+        self._closed = False
+    def _create_driver(self):
+        '''
+        启动一个新的浏览器实例
+        :return: webdriver 实例
+        '''
+        from selenium import webdriver
+        from selenium.webdriver.edge.service import Service
+        if self.options is None:
+            self.options = CourseFetcher.default_edge_options()
+        with metrics.stage("browser_start"):
+            service = Service(self.driver_path)
+            driver = webdriver.Edge(service=service, options=self.options)
+            driver.set_window_size(*self.window_size)
+        with self._lock:
+            self._render_counts[id(driver)] = 0
+        logger.info(f"浏览器池启动新实例，当前实例数: {len(self._render_counts)}")
+        return driver
+    def _destroy_driver(self, driver):
+        '''
+        关闭浏览器实例
+        :param driver: webdriver 实例
+        '''
+        with self._lock:
+            self._render_counts.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error(f"关闭浏览器实例失败: {e}")
+    def _is_healthy(self, driver):
+        '''
+        健康检查，浏览器进程崩溃或会话失效时返回 False
+        :param driver: webdriver 实例
+        :return: 是否可用
+        '''
+        try:
+            driver.execute_script("return 1")
+            return True
+        except Exception as e:
+            logger.warning(f"浏览器实例健康检查失败，将重建: {e}")
+            return False
+    def acquire(self, timeout=None):
+        '''
+        借出一个浏览器实例，池满时阻塞等待
+        :param timeout: 等待超时时间（秒）
+        :return: webdriver 实例
+        '''
+        if self._closed:
+            raise RuntimeError("浏览器池已关闭")
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("等待可用浏览器实例超时")
+        try:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                return self._create_driver()
+            if self._is_healthy(driver):
+                return driver
+            self._destroy_driver(driver)
+            return self._create_driver()
+        except Exception:
+            self._slots.release()
+            raise
+    def release(self, driver):
+        '''
+        归还浏览器实例，达到渲染次数上限或池已关闭时直接回收
+        :param driver: webdriver 实例
+        '''
+        try:
+            with self._lock:
+                count = self._render_counts.get(id(driver), 0) + 1
+                self._render_counts[id(driver)] = count
+            if self._closed or count >= self.max_renders:
+                logger.info(f"浏览器实例已渲染 {count} 次，回收")
+                self._destroy_driver(driver)
+            else:
+                self._idle.put(driver)
+        finally:
+            self._slots.release()
+    @contextmanager
+    def driver(self, timeout=None):
+        '''
+        以上下文管理器的方式借出浏览器实例
+        :param timeout: 等待超时时间（秒）
+        '''
+        driver = self.acquire(timeout=timeout)
+        try:
+            yield driver
+        except Exception:
+            # 渲染出错的实例不再放回池中
+            self._destroy_driver(driver)
+            self._slots.release()
+            raise
+        else:
+            self.release(driver)
+    def shutdown(self):
+        '''
+        关闭池中所有空闲实例，借出中的实例会在归还时关闭
+        '''
+        self._closed = True
+        closed = 0
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._destroy_driver(driver)
+            closed += 1
+        logger.info(f"浏览器池已关闭，回收实例 {closed} 个")
+class UpstreamError(Exception):
+    '''
+    教务系统请求失败（超时、连接错误或 5xx），与账号本身无关
+    '''
+class UpstreamUnavailable(UpstreamError):
+    '''
+    熔断器打开，教务系统被判定为不可用，请求未发出
+    '''
+class LoginFailed(Exception):
+    '''
+    登录后仍被重定向到登录页，通常是账号或密码错误
+    '''
+class UpstreamResponse(NamedTuple):
+    '''
+    已读取完毕的教务系统响应
+    '''
+    status: int
+    url: str
+    redirected: bool
+    text: str
+class TokenBucket:
+    '''
+    令牌桶限流，用于限制发往教务系统的请求速率和各平台的消息发送速率
+    '''
+    def __init__(self, rate, capacity):
+        '''
+           初始化
+           :param rate: 每秒补充的令牌数
+           :param capacity: 桶容量，即允许的突发请求数
+        '''
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    async def acquire(self):
+        '''
+        取出一个令牌，没有令牌时等待
+        '''
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+class CircuitBreaker:
+    '''
+    熔断器：连续失败达到阈值后打开，期间直接拒绝请求；
+    冷却时间过后只放行一个试探请求，其余请求在试探结果出来前继续被拒绝，试探成功则恢复
+    '''
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        '''
+           初始化
+           :param failure_threshold: 连续失败多少次后打开
+           :param reset_timeout: 打开后多少秒放行试探请求
+        '''
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        # 半开状态下是否已有试探请求在进行，以及它的开始时间
+        self._probe_in_flight = False
+        self._probe_started = 0
+    def before_request(self):
+        '''
+        请求前检查，熔断期间或试探请求尚未返回时抛出 UpstreamUnavailable
+        '''
+        if self.state == self.CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.reset_timeout:
+                raise UpstreamUnavailable("教务系统暂时不可用，已熔断")
+            self.state = self.HALF_OPEN
+        elif self._probe_in_flight and now - self._probe_started < self.reset_timeout:
+            raise UpstreamUnavailable("教务系统暂时不可用，等待试探请求结果")
+        # 试探请求被取消时不会记录结果，超过冷却时间后放行下一个试探请求
+        self._probe_in_flight = True
+        self._probe_started = now
+        logger.info("熔断冷却结束，放行试探请求")
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("教务系统已恢复，熔断器关闭")
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+    def record_failure(self):
+        self._probe_in_flight = False
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"教务系统连续失败 {self._failures} 次，熔断 {self.reset_timeout} 秒")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+def credential_digest(username, password):
+    '''
+    账号和密码的摘要，用于区分同一账号的不同密码，不保存明文密码
+    :param username: 用户名
+    :param password: 密码
+    :return: 十六进制摘要
+    '''
+    return hashlib.sha256(f"{username}\0{password}".encode('utf-8')).hexdigest()[:16]
+class AccountSession:
+    '''
+    单个账号（用户名 + 密码）的已登录会话
+    '''
+    def __init__(self, session):
+        self.session = session
+        self.logged_in = False
+        # 每次登录递增，用于避免并发请求同时发现过期时重复登录
+        self.generation = 0
+        self.lock = asyncio.Lock()
+class SessionManager:
+    '''
+    教务系统会话管理，所有账号共享一个连接池，每个账号持有独立的 Cookie，
+    只有在会话过期时才重新登录；所有请求统一经过限流、超时、重试和熔断
+    '''
+    def __init__(self, limit=100, rate=5, burst=10, connect_timeout=5, read_timeout=15, retries=2,
+                 backoff=0.5, breaker=None):
+        '''
+           初始化
+           :param limit: 连接池最大连接数
+           :param rate: 每秒最多发出的请求数
+           :param burst: 允许的突发请求数
+           :param connect_timeout: 连接超时（秒）
+           :param read_timeout: 读取超时（秒）
+           :param retries: 失败后的重试次数
+           :param backoff: 退避基准时间（秒），实际等待为带随机抖动的指数退避
+           :param breaker: 熔断器，为空时使用默认参数创建
+        '''
+        self.limit = limit
+        self.login_count = 0
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.timeout = None
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self._connector = None
+        self._sessions = {}
+    def get(self, username, password):
+        '''
+        获取账号对应的会话，不存在时创建；会话按用户名和密码区分，
+        错误的密码不会拿到该账号已登录的 Cookie
+        :param username: 用户名
+        :param password: 密码
+        :return: AccountSession
+        '''
+        import aiohttp
+        if self.timeout is None:
+            self.timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(limit=self.limit)
+        key = (username, credential_digest(username, password))
+        account = self._sessions.get(key)
+        if account is None or account.session.closed:
+            session = aiohttp.ClientSession(
+                connector=self._connector,
+                connector_owner=False,
+                cookie_jar=aiohttp.CookieJar(),
+            )
+            account = AccountSession(session)
+            self._sessions[key] = account
+        return account
+    async def request(self, session, method, url, **kwargs):
+        '''
+        向教务系统发送请求
+        :param session: aiohttp 会话
+        :param method: 请求方法
+        :param url: 请求地址
+        :return: UpstreamResponse
+        '''
+        import aiohttp
+        self.breaker.before_request()
+        for attempt in range(self.retries + 1):
+            await self.rate_limiter.acquire()
+            try:
+                async with session.request(method, url, timeout=self.timeout, **kwargs) as response:
+                    text = await response.text()
+                    if response.status >= 500:
+                        raise UpstreamError(f"教务系统返回 HTTP {response.status}")
+                    self.breaker.record_success()
+                    return UpstreamResponse(response.status, str(response.url), bool(response.history), text)
+            except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamError) as e:
+                if attempt >= self.retries:
+                    self.breaker.record_failure()
+                    raise UpstreamError(f"请求教务系统失败: {e!r}") from e
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.warning(f"请求教务系统失败，{delay:.1f} 秒后重试: {e!r}")
+                await asyncio.sleep(delay)
+    async def discard(self, username, password):
+        '''
+        关闭并移除账号这个密码对应的会话，用于密码错误或不再有用户使用时，避免会话和 Cookie 一直留在内存中
+        :param username: 用户名
+        :param password: 密码
+        '''
+        account = self._sessions.pop((username, credential_digest(username, password)), None)
+        if account is not None:
+            await account.session.close()
+    async def close(self):
+        '''
+        关闭所有会话和共享连接池
+        '''
+        for account in self._sessions.values():
+            await account.session.close()
+        self._sessions.clear()
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+        logger.info(f"会话管理器已关闭，本次运行共登录 {self.login_count} 次")
+class SingleFlight:
+    '''
+    并发请求合并：同一个键同时只执行一次，其余调用者等待并共享结果
+    '''
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+    async def do(self, key, func):
+        '''
+        执行或加入同键的进行中调用；调用本身在独立的任务中运行，某个调用者超时或被取消只影响它自己
+        :param key: 合并键
+        :param func: 无参协程函数
+        :return: func 的返回值
+        '''
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # shield 避免某个等待者被取消时连带取消共享的任务
+        return await asyncio.shield(task)
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 所有等待者都已离开时标记异常已被读取，不产生警告
+        if not task.cancelled():
+            task.exception()
+class ClassGroups:
+    '''
+    班级分组：同一学期内整周课表完全相同的账号视为同一个班级，组内只通过代表账号获取课表，
+    其余组员每隔一段时间自行获取一次进行校验，不一致时移出分组
+    '''
+    def __init__(self, verify_interval=3 * 24 * 3600, min_courses=3, refresh_age=10 * 60):
+        '''
+           初始化
+           :param verify_interval: 组员自行获取校验的平均间隔（秒）
+           :param min_courses: 参与分组的最少课程数，避免空课表或课很少的课表被误认为同班
+           :param refresh_age: 强制刷新时，代表账号多久以内获取的课表可直接共用（秒）
+        '''
+        self.verify_interval = verify_interval
+        self.min_courses = min_courses
+        self.refresh_age = refresh_age
+        # 分组ID -> {'term': 学期, 'members': {账号: 密码}, 'representative': 代表账号, 'digests': {周数: 摘要}}
+        self._groups = {}
+        # (学期, 账号) -> 分组ID
+        self._group_of = {}
+        # (学期, 周数, 摘要) -> 分组ID
+        self._by_digest = {}
+        # 尚未分组的账号，(学期, 周数, 摘要) -> {账号: 密码}，以及 (学期, 账号) -> 所在的键
+        self._pending = {}
+        self._pending_of = {}
+        # (学期, 账号) -> 下次需要自行获取校验的时间
+        self._next_verify = {}
+        self.shared = 0
+    def representative(self, username, password, term):
+        '''
+        查找可以代为获取课表的代表账号
+        :param username: 账号
+        :param password: 密码，与上次自行获取时不同则需要重新自行获取
+        :param term: 学期
+        :return: (代表账号, 代表密码)，不在分组中、自己就是代表或需要校验时返回 None
+        '''
+        group_id = self._group_of.get((term, username))
+        if group_id is None:
+            return None
+        group = self._groups[group_id]
+        if group['representative'] == username or group['members'].get(username) != password:
+            return None
+        if time.time() >= self._next_verify.get((term, username), 0):
+            return None
+        representative = group['representative']
+        return representative, group['members'][representative]
+    def confirm(self, username, representative, term, week, digest):
+        '''
+        代表账号获取课表后确认仍可共用：代表账号的课表与分组不一致时会在 observe 中被移出分组，
+        此时不能把它的课表（例如个人选修课）交给组员
+        :param username: 组员账号
+        :param representative: 代表账号
+        :param term: 学期
+        :param week: 教学周
+        :param digest: 代表账号这一周课表的内容哈希
+        :return: 是否可以共用
+        '''
+        group_id = self._group_of.get((term, username))
+        if group_id is None or self._group_of.get((term, representative)) != group_id:
+            return False
+        if self._groups[group_id]['digests'].get(week) != digest:
+            return False
+        self.shared += 1
+        return True
+    def observe(self, username, password, term, week, digest, course_count):
+        '''
+        记录一次自行获取的结果，用于建立和校验分组
+        :param username: 账号
+        :param password: 密码
+        :param term: 学期
+        :param week: 教学周
+        :param digest: 整周课表的内容哈希
+        :param course_count: 课程数
+        '''
+        key = (term, username)
+        # 校验时间带随机抖动，组员的校验分散到不同的日子
+        self._next_verify[key] = time.time() + self.verify_interval * random.uniform(0.5, 1.5)
+        group_id = self._group_of.get(key)
+        if group_id is not None:
+            group = self._groups[group_id]
+            expected = group['digests'].setdefault(week, digest)
+            self._by_digest[(term, week, expected)] = group_id
+            if expected == digest:
+                group['members'][username] = password
+                return
+            logger.info(f"账号 {username} 第 {week} 周的课表与所在分组不一致，移出分组")
+            self.remove(username, term)
+        if course_count < self.min_courses:
+            return
+        group_id = self._by_digest.get((term, week, digest))
+        if group_id is not None:
+            self._discard_pending(key)
+            self._groups[group_id]['members'][username] = password
+            self._group_of[key] = group_id
+            logger.info(f"账号 {username} 加入班级分组 {group_id}")
+            return
+        pending_key = (term, week, digest)
+        if self._pending_of.get(key) != pending_key:
+            self._discard_pending(key)
+        pending = self._pending.setdefault(pending_key, {})
+        pending[username] = password
+        self._pending_of[key] = pending_key
+        if len(pending) < 2:
+            return
+        # 第二个课表相同的账号出现时建立分组，先出现的账号作为代表
+        del self._pending[pending_key]
+        group_id = f"{term}#{digest[:12]}"
+        self._groups[group_id] = {
+            'term': term,
+            'members': dict(pending),
+            'representative': next(iter(pending)),
+            'digests': {week: digest},
+        }
+        self._by_digest[pending_key] = group_id
+        for member in pending:
+            self._pending_of.pop((term, member), None)
+            self._group_of[(term, member)] = group_id
+        logger.info(f"建立班级分组 {group_id}，成员 {len(pending)} 个")
+    def _discard_pending(self, key):
+        pending_key = self._pending_of.pop(key, None)
+        if pending_key is None:
+            return
+        pending = self._pending.get(pending_key, {})
+        pending.pop(key[1], None)
+        if not pending:
+            self._pending.pop(pending_key, None)
+    def remove(self, username, term):
+        '''
+        将账号移出分组，代表账号被移出时由其他组员接替，只剩一人时解散分组
+        :param username: 账号
+        :param term: 学期
+        '''
+        group_id = self._group_of.pop((term, username), None)
+        if group_id is None:
+            return
+        group = self._groups[group_id]
+        group['members'].pop(username, None)
+        if len(group['members']) < 2:
+            for member in group['members']:
+                self._group_of.pop((term, member), None)
+            del self._groups[group_id]
+            for digest_key in [k for k, v in self._by_digest.items() if v == group_id]:
+                del self._by_digest[digest_key]
+            logger.info(f"班级分组 {group_id} 已解散")
+        elif group['representative'] == username:
+            group['representative'] = next(iter(group['members']))
+    def forget(self, username):
+        '''
+        用户注销或更换账号时清除该账号的所有分组信息，之后不再用其凭据代为获取
+        :param username: 账号
+        '''
+        for term, member in [key for key in self._group_of if key[1] == username]:
+            self.remove(member, term)
+        for key in [key for key in self._pending_of if key[1] == username]:
+            self._discard_pending(key)
+        for key in [key for key in self._next_verify if key[1] == username]:
+            del self._next_verify[key]
+    def stats(self):
+        '''
+        分组统计
+        :return: (分组数, 分组内账号数)
+        '''
+        return len(self._groups), sum(len(group['members']) for group in self._groups.values())
+class TimetableCache:
+    '''
+    整周课表缓存，按 (账号, 密码摘要, 学期, 周数) 为键，带 LRU 容量上限和过期时间，可选持久化到磁盘
+    '''
+    def __init__(self, maxsize=1024, ttl=12 * 3600, path=None):
+        '''
+           初始化
+           :param maxsize: 最多缓存的条目数
+           :param ttl: 过期时间（秒）
+           :param path: 持久化文件路径，为空时只缓存在内存中
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()
+        self._persist_lock = None
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+    def get(self, key, allow_stale=False, max_age=None):
+        '''
+        读取缓存
+        :param key: (账号, 密码摘要, 学期, 周数)
+        :param allow_stale: 是否返回已过期的条目，用于教务系统不可用时兜底
+        :param max_age: 本次读取允许的最长缓存时间（秒），不超过过期时间
+        :return: 课表，未命中或已过期时返回 None
+        '''
+        entry = self._entries.get(key)
+        ttl = self.ttl if max_age is None else min(max_age, self.ttl)
+        # 过期条目保留到被 LRU 淘汰，供兜底使用
+        if entry is None or (not allow_stale and time.time() - entry[0] > ttl):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    def put(self, key, value):
+        '''
+        写入缓存，超出容量时淘汰最久未使用的条目
+        :param key: (账号, 密码摘要, 学期, 周数)
+        :param value: 课表
+        '''
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    def invalidate(self, username):
+        '''
+        清除某个账号的所有缓存
+        :param username: 账号
+        '''
+        for key in [key for key in self._entries if key[0] == username]:
+            del self._entries[key]
+    def load(self):
+        '''
+        从磁盘加载缓存，过期条目也保留，供教务系统不可用时兜底
+        '''
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+        except Exception as e:
+            logger.error(f"加载课表缓存失败: {e}")
+            return
+        for *key, stored_at, value in records[-self.maxsize:]:
+            try:
+                self._entries[tuple(key)] = (stored_at, tuple(Course(*row) for row in value))
+            except TypeError:
+                # 旧格式或损坏的条目直接丢弃，下次查询时重新获取
+                continue
+        logger.info(f"从 {self.path} 加载课表缓存 {len(self._entries)} 条")
+    async def persist(self):
+        '''
+        将缓存写入磁盘：在事件循环中取快照，序列化和写文件在线程池中进行，先写临时文件再替换，避免写到一半时损坏
+        '''
+        if not self.path:
+            return
+        records = [[*key, stored_at, value] for key, (stored_at, value) in self._entries.items()]
+        self._persist_lock = self._persist_lock or asyncio.Lock()
+        async with self._persist_lock:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, records)
+    def _write(self, records):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+class RenderCache:
+    '''
+    课表图片缓存，以渲染后 HTML 的哈希为键，相同内容的课表只截图一次，
+    磁盘占用超过上限时淘汰最久未使用的图片
+    '''
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, memory_items=64):
+        '''
+           初始化
+           :param directory: 缓存目录
+           :param max_bytes: 缓存目录占用上限（字节）
+           :param memory_items: 内存中保留的热点图片数量
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        # 内容哈希 -> [锁, 正在使用或等待该锁的请求数]
+        self._locks = {}
+        os.makedirs(directory, exist_ok=True)
+        # 按修改时间恢复最近使用顺序
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith('.png'):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total_bytes += size
+    @staticmethod
+    def key_for(content):
+        '''
+        计算内容哈希
+        :param content: 渲染后的 HTML
+        :return: 哈希字符串
+        '''
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+    async def lookup(self, key):
+        '''
+        查找已渲染的图片，优先读取内存中的热点图片，磁盘读取在线程池中进行
+        :param key: 内容哈希
+        :return: PNG 字节，未命中时返回 None
+        '''
+        png = self._memory.get(key)
+        if png is not None:
+            self._memory.move_to_end(key)
+            self._entries.move_to_end(key)
+            return png
+        if key not in self._entries:
+            return None
+        try:
+            png = await asyncio.get_running_loop().run_in_executor(None, self._read, self._path(key))
+        except OSError:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            return None
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        self._remember(key, png)
+        return png
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            png = f.read()
+        # 更新修改时间，重启后按最近使用顺序恢复
+        os.utime(path)
+        return png
+    @staticmethod
+    def _write(path, png, evicted):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(png)
+        os.replace(temp_path, path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                logger.error(f"删除缓存图片失败: {e}")
+    def _remember(self, key, png):
+        self._memory[key] = png
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+    async def store(self, key, png):
+        '''
+        将渲染好的图片放入缓存，并按占用上限淘汰旧图片，文件读写在线程池中进行
+        :param key: 内容哈希
+        :param png: PNG 字节
+        '''
+        self._remember(key, png)
+        self._total_bytes += len(png) - self._entries.get(key, 0)
+        self._entries[key] = len(png)
+        self._entries.move_to_end(key)
+        evicted = []
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, old_size = self._entries.popitem(last=False)
+            self._memory.pop(old_key, None)
+            self._total_bytes -= old_size
+            evicted.append(self._path(old_key))
+        await asyncio.get_running_loop().run_in_executor(None, self._write, self._path(key), png, evicted)
+    async def get_or_render(self, content, render):
+        '''
+        命中缓存时直接返回图片，否则调用 render 渲染后写入缓存；
+        同一内容的并发请求只渲染一次
+        :param content: 渲染后的 HTML
+        :param render: 渲染协程函数，参数为 content，返回 PNG 字节
+        :return: PNG 字节
+        '''
+        key = self.key_for(content)
+        # 锁释放后等待者被唤醒前 locked() 已为 False，按引用计数回收，避免同一内容被并发渲染
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                png = await self.lookup(key)
+                if png is not None:
+                    self.hits += 1
+                    logger.info(f"课表图片命中缓存: {key[:12]}")
+                    return png
+                self.misses += 1
+                png = await render(content)
+                await self.store(key, png)
+                return png
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+# 课表图片的 HTML 模板
+SCHEDULE_TMPL = """<!DOCTYPE html>
         <html lang="zh-CN">
         <head>
             <meta charset="UTF-8">
@@ -152,6 +1386,319 @@ class CourseFetcher:
             </div>
         </body>
         </html>"""
+# Jinja2 字节码缓存目录，设置 COURSE_TEMPLATE_CACHE_DIR 后重启进程也无需重新编译模板
+TEMPLATE_BYTECODE_CACHE_DIR = os.environ.get("COURSE_TEMPLATE_CACHE_DIR")
+@lru_cache(maxsize=None)
+def template_environment():
+    '''
+    进程内共享的 Jinja2 环境
+    :return: Environment
+    '''
+    from jinja2 import Environment, DictLoader, FileSystemBytecodeCache
+    bytecode_cache = None
+    if TEMPLATE_BYTECODE_CACHE_DIR:
+        os.makedirs(TEMPLATE_BYTECODE_CACHE_DIR, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(TEMPLATE_BYTECODE_CACHE_DIR)
+    return Environment(
+        loader=DictLoader({"schedule.html": SCHEDULE_TMPL}),
+        bytecode_cache=bytecode_cache,
+        auto_reload=False,
+    )
+@lru_cache(maxsize=16)
+def compile_template(template_str):
+    '''
+    编译模板，同一模板字符串每个进程只编译一次
+    :param template_str: HTML 模板字符串
+    :return: Template
+    '''
+    env = template_environment()
+    if template_str == SCHEDULE_TMPL:
+        # 通过加载器获取内置模板，才能命中字节码缓存
+        return env.get_template("schedule.html")
+    return env.from_string(template_str)
+def render_template(template_str, data):
+    '''
+    渲染 HTML 模板
+    :param template_str: HTML 模板字符串
+    :param data: 渲染数据
+    :return: 渲染后的 HTML 字符串
+    '''
+    return compile_template(template_str).render(data)
+class SeleniumRenderBackend:
+    '''
+    浏览器渲染后端：用 Jinja2 模板生成 HTML，再由无头 Edge 截图
+    '''
+    name = "selenium"
+    def __init__(self, browser_pool, template_str):
+        '''
+           初始化
+           :param browser_pool: 浏览器池
+           :param template_str: HTML 模板字符串
+        '''
+        self.browser_pool = browser_pool
+        self.template_str = template_str
+    def document(self, data):
+        '''
+        生成待渲染的文档，同时作为图片缓存的内容
+        :param data: 渲染数据
+        :return: HTML 字符串
+        '''
+        return render_template(self.template_str, data)
+    def render(self, document):
+        '''
+        截图渲染 HTML，直接返回 PNG 数据，不经过磁盘
+        :param document: HTML 内容
+        :return: PNG 字节
+        '''
+        # 以 data URL 加载页面，无需写临时 HTML 文件
+        page_url = "data:text/html;charset=utf-8;base64," + base64.b64encode(document.encode("utf-8")).decode("ascii")
+        # 从浏览器池借出实例，窗口大小在实例创建时已设置
+        with self.browser_pool.driver() as driver:
+            driver.get(page_url)
+            png = driver.get_screenshot_as_png()
+        logger.info(f"课表图片已生成: {len(png)} 字节")
+        return png
+class PillowRenderBackend:
+    '''
+    原生渲染后端：用 Pillow 按 TMPL 的卡片布局直接绘制课表，不依赖浏览器
+    '''
+    name = "pillow"
+    # 按 2 倍分辨率绘制，清晰度不低于浏览器截图
+    SCALE = 2
+    WIDTH = 630
+    # 依次尝试的中文字体，可通过 COURSE_FONT_PATH 环境变量指定
+    FONT_CANDIDATES = (
+        "msyh.ttc",
+        "C:/Windows/Fonts/msyh.ttc",
+        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+        "/usr/share/fonts/wqy-microhei/wqy-microhei.ttc",
+        "/System/Library/Fonts/PingFang.ttc",
+    )
+    def document(self, data):
+        '''
+        生成待渲染的文档，同时作为图片缓存的内容
+        :param data: 渲染数据
+        :return: JSON 字符串
+        '''
+        return json.dumps({
+            "backend": self.name,
+            "weeks": data["weeks"],
+            "day": data["day"],
+            "courses": [course._asdict() for course in data["courses"]],
+        }, ensure_ascii=False, sort_keys=True)
+    @classmethod
+    @lru_cache(maxsize=None)
+    def font_path(cls):
+        '''
+        查找可用的中文字体
+        :return: 字体路径，找不到时返回 None
+        '''
+        from PIL import ImageFont
+        candidates = [os.environ.get("COURSE_FONT_PATH")] + list(cls.FONT_CANDIDATES)
+        for path in candidates:
+            if not path:
+                continue
+            try:
+                ImageFont.truetype(path, 12)
+                return path
+            except OSError:
+                continue
+        logger.warning("未找到中文字体，课表图片中的中文可能无法显示，请设置 COURSE_FONT_PATH")
+        return None
+    @classmethod
+    @lru_cache(maxsize=None)
+    def font(cls, size):
+        '''
+        加载指定字号的字体，结果按字号缓存
+        :param size: 字号（已乘以缩放倍数）
+        :return: ImageFont
+        '''
+        from PIL import ImageFont
+        path = cls.font_path()
+        if path is None:
+            return ImageFont.load_default(size)
+        return ImageFont.truetype(path, size)
+    @staticmethod
+    def wrap(text, font, width):
+        '''
+        按像素宽度逐字换行
+        :param text: 文本
+        :param font: 字体
+        :param width: 最大宽度
+        :return: 行列表
+        '''
+        lines, line = [], ""
+        for char in text:
+            if line and font.getlength(line + char) > width:
+                lines.append(line)
+                line = char
+            else:
+                line += char
+        lines.append(line)
+        return lines
+    def render(self, document):
+        '''
+        绘制课表图片
+        :param document: document() 生成的 JSON
+        :return: PNG 字节
+        '''
+        data = json.loads(document)
+        k = self.SCALE
+        title_font = self.font(18 * k)
+        time_font = self.font(14 * k)
+        name_font = self.font(15 * k)
+        item_font = self.font(13 * k)
+        type_font = self.font(12 * k)
+        # 与 TMPL 中的 CSS 尺寸保持一致
+        body_padding, container_padding = 15 * k, 15 * k
+        container_width = (self.WIDTH - 30) * k
+        time_width = 100 * k
+        block_padding = 10 * k
+        details_width = container_width - 2 * container_padding - time_width - 2 * 15 * k
+        blocks = []
+        for course in data["courses"]:
+            lines = [(line, name_font, "#333333", 20 * k, True)
+                     for line in self.wrap(course["course_name"], name_font, details_width)]
+            lines += [(line, item_font, "#666666", 18 * k, False)
+                      for line in self.wrap(f"教师: {course['teacher']}", item_font, details_width)]
+            lines += [(line, item_font, "#666666", 18 * k, False)
+                      for line in self.wrap(f"地点: {course['location']}", item_font, details_width)]
+            lines += [(line, type_font, "#888888", 18 * k, False)
+                      for line in self.wrap(f"类型: {course['course_type']}", type_font, details_width)]
+            height = 2 * block_padding + sum(line[3] for line in lines)
+            blocks.append((course["time_slot"], lines, height))
+        title_height = 40 * k
+        content_height = title_height + 15 * k + sum(height + 12 * k for _, _, height in blocks)
+        image_height = content_height + 2 * container_padding + 2 * body_padding
+        from PIL import Image as PILImage, ImageDraw
+        image = PILImage.new("RGB", (self.WIDTH * k, image_height), "#f0f2f5")
+        draw = ImageDraw.Draw(image)
+        left = (self.WIDTH * k - container_width) // 2
+        draw.rounded_rectangle(
+            (left, body_padding, left + container_width, image_height - body_padding),
+            radius=12 * k, fill="white")
+        inner_left = left + container_padding
+        inner_right = left + container_width - container_padding
+        top = body_padding + container_padding
+        title = f"第 {data['weeks']}周 周{data['day']}课程表"
+        draw.text(((inner_left + inner_right) // 2, top + 12 * k), title, font=title_font, fill="#333333",
+                  anchor="mm", stroke_width=1, stroke_fill="#333333")
+        top += title_height
+        draw.line((inner_left, top, inner_right, top), fill="#eeeeee", width=k)
+        top += 15 * k
+        for time_slot, lines, height in blocks:
+            draw.rounded_rectangle((inner_left, top, inner_right, top + height), radius=10 * k, fill="#f8f9fa")
+            draw.rounded_rectangle((inner_left, top, inner_left + time_width, top + height), radius=10 * k,
+                                   fill="#4a6fd5", corners=(True, False, False, True))
+            draw.text((inner_left + time_width // 2, top + height // 2), time_slot, font=time_font, fill="white",
+                      anchor="mm")
+            y = top + block_padding
+            x = inner_left + time_width + 15 * k
+            for text, font, color, line_height, bold in lines:
+                stroke = 1 if bold else 0
+                draw.text((x, y), text, font=font, fill=color, stroke_width=stroke, stroke_fill=color)
+                y += line_height
+            top += height + 12 * k
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=False)
+        return buffer.getvalue()
+# 文字课表的表头和单节课格式
+COURSE_TEXT_HEADER = "|-----------时间段----------|\n|------课程名称------| 教师 |\n|-------地点------| 课程类型 |\n"
+COURSE_TEXT_ROW = "|--------{0}-------|\n| {1} | {2} |\n|------{3}-----| {4} |\n"
+def courses_to_text(courses):
+    '''
+    将课程转换为文字课表，不经过模板和渲染
+    :param courses: Course 列表
+    :return: 文字课表
+    '''
+    row = COURSE_TEXT_ROW.format
+    return COURSE_TEXT_HEADER + "".join(
+        [row(course.time_slot, course.course_name, course.teacher, course.location, course.course_type)
+         for course in courses])
+class CourseFetcher:
+    '''
+    课程处理类负责与教务系统进行交互
+    '''
+    # 教务系统登录URL
+    LOGIN_URL = "https://qzjwpc.cqvtu.edu.cn/jsxsd/xk/LoginToXk"
+    # 课程表URL格式
+    TMPL = SCHEDULE_TMPL
+    # 学年学期号和时间模式由学期配置提供
+    TIMETABLE_URL_FORMAT = "https://qzjwpc.cqvtu.edu.cn/jsxsd/framework/mainV_index_loadkb.htmlx?rq={date}&sjmsValue={sjms}&xnxqid={xnxqid}&xswk=false"
+    # 会话过期时服务器会重定向回登录页：登录接口本身，或系统首页（即登录页）；只按完整路径匹配，
+    # 系统内其他页面之间的跳转不视为会话过期
+    LOGIN_PAGE_PATHS = ("/jsxsd/xk/LoginToXk", "/jsxsd/", "/jsxsd", "/jsxsd/index.jsp")
+    HEADERS = {
+        'Host': 'qzjwpc.cqvtu.edu.cn',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+        'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Origin': 'https://qzjwpc.cqvtu.edu.cn',
+        'Referer': 'https://qzjwpc.cqvtu.edu.cn/jsxsd/xk/LoginToXk',
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36 Edg/137.0.0.0',
+    }
+    def __init__(self, username, password, terms=None, browser_pool=None, session_manager=None,
+                 timetable_cache=None, render_cache=None, render_backend="auto", single_flight=None, campus=None,
+                 class_groups=None):
+        '''
+           初始化
+           :param username: 用户名
+           :param password: 密码
+           :param terms: 学期日历注册表，为空时使用内置配置
+           :param browser_pool: 共享的浏览器池，为空时每次渲染单独启动浏览器
+           :param session_manager: 共享的会话管理器，为空时每次请求单独登录
+           :param timetable_cache: 共享的课表缓存，为空时不缓存
+           :param render_cache: 共享的图片缓存，为空时每次都重新截图
+           :param render_backend: 渲染后端名称，selenium / pillow / auto
+           :param single_flight: 共享的请求合并器，为空时不合并并发请求
+           :param campus: 校区，为空时使用默认校区
+           :param class_groups: 共享的班级分组，为空时每个账号都自行获取
+        '''
+        self.username = username
+        self.password = password
+        self.terms = terms or TermRegistry()
+        self.campus = campus
+        self.class_groups = class_groups
+        self.render_backend_name = render_backend
+        self.session_manager = session_manager
+        self.timetable_cache = timetable_cache
+        self.render_cache = render_cache
+        self.single_flight = single_flight
+        self.driver_path = self.default_driver_path()
+        # 未传入浏览器池时退化为用完即关的单实例池，与原先的行为一致
+        self.browser_pool = browser_pool or BrowserPool(self.driver_path, size=1, max_renders=1)
+        self.num_map = {
+            0: '零',
+            1: '一',
+            2: '二',
+            3: '三',
+            4: '四',
+            5: '五',
+            6: '六',
+            7: '七',
+        }
+        # 渲染后端在第一次出图时才创建，只推送文字时不检查字体、不导入 PIL
+        self._render_backend = None
+    @staticmethod
+    def default_edge_options():
+        '''
+        默认的 Edge 启动参数
+        :return: Options
+        '''
+        from selenium.webdriver.edge.options import Options
+        edge_options = Options()
+        edge_options.add_argument("--headless")  # 无头模式
+        return edge_options
+    @staticmethod
+    def default_driver_path():
+        '''
+        默认的 msedgedriver 路径
+        :return: 路径字符串
+        '''
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(script_dir, "msedgedriver.exe")
     def to_base64(self, input_str):
         '''
         将字符串转换为base64编码
@@ -168,185 +1715,790 @@ class CourseFetcher:
         :param data: 渲染数据
         :return: 渲染后的 HTML 字符串
         '''
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(template_str)
-        return template.render(data)
-    def _generate_image(self, html_content, output_path):
-        # 创建一个临时 HTML 文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".html") as temp_file:
-            temp_file.write(html_content.encode("utf-8"))
-            temp_file_path = temp_file.name
-        service = Service(self.driver_path)
-        driver = webdriver.Edge(service=service, options=self.edge_options)
-        try:
-            # 设置浏览器窗口大小（可根据需要调整）
-            driver.set_window_size(800, 700)  # 设置宽度和高度
-
-            # 加载临时 HTML 文件
-            driver.get(f"file://{temp_file_path}")
-            # 截图并保存
-            if os.path.exists(output_path):
-                os.remove(output_path)
-                logger.info(f"已删除旧图片: {output_path}")
-            driver.save_screenshot(output_path)
-            logger.info(f"图片已保存到: {output_path}")
-
-        finally:
-            # 关闭浏览器
-            driver.quit()
-            # 删除临时文件
+        return render_template(template_str, data)
+    def _generate_image(self, html_content):
+        '''
+        截图渲染 HTML，直接返回 PNG 数据，不经过磁盘
+        :param html_content: HTML 内容
+        :return: PNG 字节
+        '''
+        return SeleniumRenderBackend(self.browser_pool, self.TMPL).render(html_content)
+    @property
+    def render_backend(self):
+        '''
+        本实例使用的渲染后端
+        :return: 渲染后端
+        '''
+        if self._render_backend is None:
+            self._render_backend = self.make_render_backend(self.render_backend_name)
+        return self._render_backend
+    @staticmethod
+    def resolve_render_backend(name):
+        '''
+        确定实际可用的渲染后端
+        :param name: selenium / pillow / auto
+        :return: 后端名称；auto 既找不到 msedgedriver 也找不到中文字体时返回 None，此时图片中的中文无法显示
+        '''
+        if name != "auto":
+            return name
+        if os.path.exists(CourseFetcher.default_driver_path()):
+            return "selenium"
+        try:
+            font_path = PillowRenderBackend.font_path()
+        except ImportError:
+            return None
+        return "pillow" if font_path is not None else None
+    def make_render_backend(self, name):
+        '''
+        创建渲染后端
+        :param name: selenium / pillow / auto，按 resolve_render_backend 选择；没有可用后端时插件改为文字推送，
+                     仍被要求出图时使用 pillow 和默认字体
+        :return: 渲染后端
+        '''
+        name = self.resolve_render_backend(name) or "pillow"
+        if name == "pillow":
+            return PillowRenderBackend()
+        if name == "selenium":
+            return SeleniumRenderBackend(self.browser_pool, self.TMPL)
+        raise ValueError(f"未知的渲染后端: {name}")
+    async def login(self, session_manager, session):
+        '''
+        登录教务系统，登录态保存在会话的 Cookie 中
+        :param session_manager: 会话管理器
+        :param session: aiohttp 会话
+        '''
+        encoded_str = f"{self.to_base64(self.username)}%%%{self.to_base64(self.password)}"
+        data = {
+            'loginMethod': "LoginToXk",
+            'userAccount': self.username,
+            'userPassword': self.password,
+            'encoded': encoded_str,
+        }
+        with metrics.stage("login"):
+            await session_manager.request(session, "POST", self.LOGIN_URL, headers=self.HEADERS, data=data)
+        logger.info(f"账号 {self.username} 已登录教务系统")
+    def is_login_redirect(self, response):
+        '''
+        判断响应是否被重定向回登录页（会话已过期）
+        :param response: UpstreamResponse
+        :return: 是否需要重新登录
+        '''
+        if not response.redirected:
+            return False
+        return urlsplit(response.url).path in self.LOGIN_PAGE_PATHS
+    def cache_key(self, term, weeks):
+        '''
+        整周课表的缓存键，包含密码摘要，只有用同一密码成功获取过的调用者才能读到缓存（包括过期的兜底缓存）
+        :param term: 学期日历
+        :param weeks: 教学周
+        :return: (账号, 密码摘要, 学期, 周数)
+        '''
+        return self.username, credential_digest(self.username, self.password), term.key, weeks
+    async def fetch_timetable_html(self, session_manager, date, term=None):
+        '''
+        使用缓存的会话获取课表 HTML，未登录或会话过期时才登录
+        :param session_manager: 会话管理器
+        :param date: 日期字符串
+        :param term: 学期日历，默认为今天所在的学期
+        :return: 课表 HTML
+        '''
+        term = term or self.term_for()
+        account = session_manager.get(self.username, self.password)
+        timetable_url = self.TIMETABLE_URL_FORMAT.format(date=date, sjms=term.sjms_value, xnxqid=term.xnxqid)
+        for attempt in range(2):
+            # 同一账号的并发请求只登录一次
+            async with account.lock:
+                if not account.logged_in:
+                    await self.login(session_manager, account.session)
+                    session_manager.login_count += 1
+                    account.generation += 1
+                    account.logged_in = True
+                generation = account.generation
+            with metrics.stage("timetable_get"):
+                timetable_response = await session_manager.request(
+                    account.session, "GET", timetable_url, headers=self.HEADERS)
+            if not self.is_login_redirect(timetable_response):
+                return timetable_response.text
+            logger.info(f"账号 {self.username} 会话已过期，重新登录")
+            if account.generation == generation:
+                account.logged_in = False
+        # 密码错误的会话不会再被使用
+        await session_manager.discard(self.username, self.password)
+        raise LoginFailed("重新登录后仍被重定向到登录页")
+    async def get_week_timetable(self, force_refresh=False, date=None, max_age=None):
+        '''
+        获取整周课表，优先使用缓存，同班账号通过代表账号获取
+        :param force_refresh: 是否跳过缓存强制从教务系统获取
+        :param date: 要获取的那一周中的任意一天，默认今天
+        :param max_age: 允许使用的最长缓存时间（秒），默认为缓存的过期时间
+        :return: WeekTimetable
+        '''
+        date = date or datetime.now().date()
+        term = self.term_for(date)
+        weeks = term.week(date)
+        cache_key = self.cache_key(term, weeks)
+        if self.timetable_cache is not None and not force_refresh:
+            courses = self.timetable_cache.get(cache_key, max_age=max_age)
+            if courses is not None:
+                logger.info(f"账号 {self.username} {term.xnxqid} 第 {weeks} 周课表命中缓存")
+                return WeekTimetable(weeks, courses, term.slot_table)
+        if self.class_groups is not None:
+            representative = self.class_groups.representative(self.username, self.password, term.key)
+            if representative is not None:
+                week = await self.fetch_shared_week_timetable(representative, date, term, force_refresh)
+                if week is not None:
+                    return week
+        if self.single_flight is None:
+            return await self.fetch_week_timetable(date, term)
+        # 同一账号同一周的并发请求共享一次获取，键与缓存键一样包含密码摘要，避免错误密码拿到他人结果
+        flight_key = cache_key
+        return await self.single_flight.do(flight_key, lambda: self.fetch_week_timetable(date, term))
+    async def fetch_shared_week_timetable(self, representative, date, term, force_refresh):
+        '''
+        通过同班的代表账号获取整周课表，代表账号登录失败时将其移出分组，教务系统出错时交给组员自行获取
+        :param representative: (代表账号, 代表密码)
+        :param date: 那一周中的任意一天
+        :param term: 学期日历
+        :param force_refresh: 是否强制刷新，此时只共用代表账号最近获取的课表
+        :return: WeekTimetable，代表账号不可用或课表已与分组不一致时返回 None
+        '''
+        username, password = representative
+        representative_fetcher = CourseFetcher(
+            username, password, self.terms,
+            browser_pool=self.browser_pool,
+            session_manager=self.session_manager,
+            timetable_cache=self.timetable_cache,
+            render_backend=self.render_backend_name,
+            single_flight=self.single_flight,
+            campus=self.campus,
+            class_groups=self.class_groups,
+        )
+        try:
+            week = await representative_fetcher.get_week_timetable(
+                date=date, max_age=self.class_groups.refresh_age if force_refresh else None)
+        except LoginFailed:
+            logger.warning(f"代表账号 {username} 登录失败，移出班级分组")
+            self.class_groups.remove(username, term.key)
+            return None
+        except (UpstreamError, asyncio.TimeoutError) as e:
+            # 由组员自己的账号重试，教务系统仍不可用时使用组员自己的过期缓存兜底
+            logger.warning(f"通过代表账号 {username} 获取课表失败，账号 {self.username} 自行获取: {e!r}")
+            return None
+        if not self.class_groups.confirm(self.username, username, term.key, week.weeks, timetable_digest(week.courses)):
+            logger.info(f"同班账号 {username} 的第 {week.weeks} 周课表与分组不一致，账号 {self.username} 自行获取")
+            return None
+        logger.info(f"账号 {self.username} 使用同班账号 {username} 的第 {week.weeks} 周课表")
+        if self.timetable_cache is not None:
+            self.timetable_cache.put(self.cache_key(term, week.weeks), week.courses)
+        return week
+    async def fetch_week_timetable(self, date, term):
+        '''
+        从教务系统获取并解析整周课表，写入缓存
+        :param date: 那一周中的任意一天
+        :param term: 学期日历
+        :return: WeekTimetable
+        '''
+        weeks = term.week(date)
+        cache_key = self.cache_key(term, weeks)
+        # 未传入会话管理器时使用临时会话，用完即关
+        session_manager = self.session_manager or SessionManager(limit=1)
+        try:
+            html_content = await self.fetch_timetable_html(session_manager, date.strftime("%Y-%m-%d"), term)
+        except UpstreamError:
+            # 教务系统不可用时退而使用已过期的缓存
+            courses = self.timetable_cache.get(cache_key, allow_stale=True) if self.timetable_cache is not None else None
+            if courses is None:
+                raise
+            logger.warning(f"教务系统不可用，账号 {self.username} 使用缓存的第 {weeks} 周课表")
+            return WeekTimetable(weeks, courses, term.slot_table)
+        finally:
+            if self.session_manager is None:
+                await session_manager.close()
+        with metrics.stage("parse"):
+            courses = self.parse_timetable(html_content, term.slot_table)
+        if self.timetable_cache is not None:
+            self.timetable_cache.put(cache_key, courses)
+        if self.class_groups is not None:
+            self.class_groups.observe(
+                self.username, self.password, term.key, weeks, timetable_digest(courses), len(courses))
+        return WeekTimetable(weeks, courses, term.slot_table)
+    async def get_courses(self, force_refresh=False):
+        '''
+        获取课程信息
+        :param force_refresh: 是否跳过缓存强制从教务系统获取
+        :return: 返回今日课程、周数、今日提醒，获取失败时抛出异常
+        '''
+        week = await self.get_week_timetable(force_refresh=force_refresh)
+        weeks, today_courses, today_reminder = self.select_day(week)
+        return today_courses, weeks, today_reminder
+    async def get_daily_timetable(self, html_content):
+        '''
+        获取每日课表
+        :param html_content: HTML内容
+        :return: 返回周数、今日课程、今日提醒
+        '''
+        term = self.term_for()
+        return self.select_day(WeekTimetable(
+            self.current_week(), self.parse_timetable(html_content, term.slot_table), term.slot_table))
+    def term_for(self, date=None):
+        '''
+        日期所在的学期
+        :param date: 日期，默认今天
+        :return: TermCalendar
+        '''
+        return self.terms.term_for(date, self.campus)
+    def current_week(self, date=None):
+        '''
+        计算教学周
+        :param date: 日期，默认今天
+        :return: 周数
+        '''
+        date = date or datetime.now().date()
+        return self.term_for(date).week(date)
+    def select_day(self, week, day=None):
+        '''
+        从整周课表中取出某天的课程和提醒
+        :param week: WeekTimetable
+        :param day: 星期几（1-7），默认今天
+        :return: 返回周数、当天课程、当天提醒
+        '''
+        day = day or datetime.today().isoweekday()
+        courses = week.on_day(day)
+        reminders = [{'reminder_time': course.reminder_time, 'reminder': course.reminder} for course in courses]
+        return week.weeks, courses, reminders
+    def parse_timetable(self, html_content, slot_table=None):
+        '''
+        解析整周课表
+        :param html_content: HTML内容
+        :param slot_table: 作息时间表，默认使用今天所在学期的作息
+        :return: 整周课程，Course 元组
+        '''
+        return parse_timetable(html_content, slot_table or self.term_for().slot_table)
+    async def html_to_image(self, html_content):
+        """将 HTML 内容渲染为 PNG 字节，使用 Edge 浏览器"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._generate_image, html_content)
+    async def json_to_markdown(self, course_data):
+        '''
+        将课程数据转换为Markdown格式，一次拼接完成
+        :param course_data: 课程数据
+        :return: Markdown格式的字符串
+        '''
+        return courses_to_text(course_data)
+    async def render_document(self, document):
+        """在线程池中调用渲染后端生成 PNG 字节"""
+        loop = asyncio.get_event_loop()
+        with metrics.stage(f"render_{self.render_backend.name}"):
+            return await loop.run_in_executor(None, self.render_backend.render, document)
+    async def generate_schedule_image(self, courses, weeks):
+        """生成课程表 HTML 并渲染为 PNG 字节"""
+        # 构建数据字典
+        data = {
+            "weeks": weeks,
+            "day": self.num_map.get(courses[0].day, "未知"),
+            "courses": courses
+        }
+        # 生成待渲染文档，浏览器后端为 HTML，原生后端为课表 JSON
+        with metrics.stage("render_template"):
+            document = self.render_backend.document(data)
+
+        # 生成图片，相同内容的课表复用已有图片
+        if self.render_cache is None:
+            return await self.render_document(document)
+        return await self.render_cache.get_or_render(document, self.render_document)
+class DeliveryQueue:
+    '''
+    出站消息队列：按平台分队列，每个平台由各自的工作协程按该平台的速率发送，失败时带抖动指数退避重试；
+    某个平台变慢或限流只影响它自己的队列，发送失败单独统计，不会被当作课表获取失败
+    '''
+    def __init__(self, send, rates=None, default_rate=5, workers=2, timeout=15, retries=3, backoff=2.0):
+        '''
+           初始化
+           :param send: 实际发送消息的协程函数，参数为 (消息来源, 消息链)
+           :param rates: {平台ID: 每秒发送条数}
+           :param default_rate: 未配置的平台每秒发送条数
+           :param workers: 每个平台的工作协程数
+           :param timeout: 单次发送超时（秒）
+           :param retries: 失败后的重试次数
+           :param backoff: 退避基准时间（秒）
+        '''
+        self.send = send
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._queues = {}
+        self._tasks = {}
+        self.delivered = {}
+        self.failed = {}
+        self.retried = 0
+    @staticmethod
+    def platform_of(umo):
+        '''
+        从消息来源（平台ID:消息类型:会话ID）中取出平台ID
+        :param umo: 消息来源
+        :return: 平台ID
+        '''
+        return umo.split(':', 1)[0] if umo else ''
+    def _queue_for(self, platform):
+        '''
+        取得平台的队列，第一次使用时启动该平台的工作协程
+        :param platform: 平台ID
+        :return: asyncio.Queue
+        '''
+        queue_ = self._queues.get(platform)
+        if queue_ is None:
+            queue_ = self._queues[platform] = asyncio.Queue()
+            rate = self.rates.get(platform, self.default_rate)
+            limiter = TokenBucket(rate, max(1, int(rate)))
+            self._tasks[platform] = [
+                asyncio.ensure_future(self._work(platform, queue_, limiter)) for _ in range(self.workers)]
+            self.delivered.setdefault(platform, 0)
+            self.failed.setdefault(platform, 0)
+        return queue_
+    async def deliver(self, umo, message_chain):
+        '''
+        将消息放入对应平台的队列并等待结果，调用方被取消时消息仍会发出
+        :param umo: 消息来源
+        :param message_chain: 消息链
+        :return: 是否送达，重试耗尽后返回 False
+        '''
+        future = asyncio.get_event_loop().create_future()
+        self._queue_for(self.platform_of(umo)).put_nowait((umo, message_chain, future, time.perf_counter()))
+        return await asyncio.shield(future)
+    async def _work(self, platform, queue_, limiter):
+        while True:
+            umo, message_chain, future, enqueued = await queue_.get()
+            try:
+                delivered = await self._send_with_retry(platform, umo, message_chain, limiter)
+                metrics.observe("delivery", time.perf_counter() - enqueued, error=not delivered)
+                if not future.done():
+                    future.set_result(delivered)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.set_result(False)
+                raise
+            finally:
+                queue_.task_done()
+    async def _send_with_retry(self, platform, umo, message_chain, limiter):
+        '''
+        按平台速率发送一条消息，失败时退避重试
+        :return: 是否送达
+        '''
+        for attempt in range(self.retries + 1):
+            await limiter.acquire()
+            try:
+                with metrics.stage("send"):
+                    await asyncio.wait_for(self.send(umo, message_chain), self.timeout)
+                self.delivered[platform] += 1
+                return True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt >= self.retries:
+                    self.failed[platform] += 1
+                    logger.error(f"向 {umo} 发送消息失败，已重试 {self.retries} 次: {e!r}")
+                    return False
+                self.retried += 1
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.warning(f"向 {umo} 发送消息失败，{delay:.1f} 秒后重试: {e!r}")
+                await asyncio.sleep(delay)
+    def stats(self):
+        '''
+        各平台的发送统计
+        :return: {平台ID: (排队中, 已送达, 失败)}
+        '''
+        return {platform: (queue_.qsize(), self.delivered[platform], self.failed[platform])
+                for platform, queue_ in self._queues.items()}
+    async def close(self, timeout=10):
+        '''
+        等待队列中的消息发完（最多 timeout 秒），然后停止工作协程，未发出的消息视为失败
+        :param timeout: 等待时间（秒）
+        '''
+        queues = list(self._queues.values())
+        if queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*[queue_.join() for queue_ in queues]), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"关闭时仍有 {sum(queue_.qsize() for queue_ in queues)} 条消息未发出")
+        tasks = [task for platform_tasks in self._tasks.values() for task in platform_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for queue_ in queues:
+            while not queue_.empty():
+                future = queue_.get_nowait()[2]
+                if not future.done():
+                    future.set_result(False)
+        self._queues.clear()
+        self._tasks.clear()
+# 写入审计日志前需要去掉的字段
+SENSITIVE_FIELDS = frozenset(('password', 'userPassword', 'encoded', 'token', 'secret'))
+def redact(value):
+    '''
+    递归去掉字典中的密码等敏感字段
+    :param value: 任意可 JSON 序列化的值
+    :return: 脱敏后的副本
+    '''
+    if isinstance(value, dict):
+        return {key: '***' if key in SENSITIVE_FIELDS else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+class AuditLog:
+    '''
+    异步缓冲的追加日志：记录为 JSON Lines，先放入有上限的内存缓冲，由后台协程成批在线程池中写盘，
+    文件超过大小上限时轮转，写入前去掉密码等敏感字段
+    '''
+    def __init__(self, path, max_bytes=5 * 1024 * 1024, backups=3, flush_interval=2.0, batch_size=100,
+                 max_buffer=10000):
+        '''
+           初始化
+           :param path: 日志文件路径
+           :param max_bytes: 单个文件的大小上限（字节），超过后轮转
+           :param backups: 保留的历史文件数，即 path.1 ~ path.N
+           :param flush_interval: 定期写盘的间隔（秒）
+           :param batch_size: 缓冲达到多少条时立即写盘
+           :param max_buffer: 缓冲上限，写盘跟不上时丢弃最旧的记录
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = deque(maxlen=max_buffer)
+        self._wakeup = None
+        self._lock = None
+        self._task = None
+        self.written = 0
+        self.dropped = 0
+    def write(self, event, **fields):
+        '''
+        追加一条记录，只放入内存缓冲，不阻塞事件循环
+        :param event: 事件类型
+        :param fields: 记录内容
+        '''
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append({'time': datetime.now().isoformat(timespec='seconds'), 'event': event, **redact(fields)})
+        self._ensure_flusher()
+        if len(self._buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+    def _ensure_flusher(self):
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中时只缓冲，关闭时再写盘
+            return
+        self._wakeup = asyncio.Event()
+        self._lock = self._lock or asyncio.Lock()
+        self._task = asyncio.ensure_future(self._run())
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"写入日志 {self.path} 失败: {e!r}")
+    async def flush(self):
+        '''
+        将缓冲中的记录成批写盘
+        '''
+        if not self._buffer:
+            return
+        self._lock = self._lock or asyncio.Lock()
+        async with self._lock:
+            records = []
+            while self._buffer:
+                records.append(self._buffer.popleft())
+            data = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records)
+            await asyncio.get_running_loop().run_in_executor(None, self._append, data)
+            self.written += len(records)
+    def _append(self, data):
+        '''
+        在线程池中追加写入，写入后超过大小上限时先轮转
+        :param data: 若干行 JSON
+        '''
+        encoded = data.encode('utf-8')
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size and size + len(encoded) > self.max_bytes:
+            self._rotate()
+        with open(self.path, 'ab') as f:
+            f.write(encoded)
+    def _rotate(self):
+        '''
+        path -> path.1 -> path.2 ...，超出保留数量的最旧文件被覆盖
+        '''
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+    async def close(self):
+        '''
+        停止后台协程并写入剩余的记录
+        '''
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self.dropped:
+            logger.warning(f"日志 {self.path} 因写盘不及丢弃了 {self.dropped} 条记录")
+class UserStore:
+    '''
+    用户和待发送提醒的存储，基于 SQLite WAL 模式，每次修改只写入单行；
+    首次启动时自动导入旧的 user.ini
+    '''
+    FIELDS = ('platform', 'umo', 'user', 'password', 'status', 'mode', 'campus')
+    DEFAULTS = {'mode': 'image'}
+    def __init__(self, path='user.db', legacy_ini='user.ini'):
+        '''
+           初始化
+           :param path: 数据库文件路径
+           :param legacy_ini: 需要导入的旧配置文件路径
+        '''
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id TEXT PRIMARY KEY, platform TEXT, umo TEXT, user TEXT, password TEXT, status TEXT, "
+            "mode TEXT DEFAULT 'image', campus TEXT DEFAULT '')")
+        # 旧版数据库缺少后来新增的列（推送模式、校区），逐个补上
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        for column, definition in (('mode', "TEXT DEFAULT 'image'"), ('campus', "TEXT DEFAULT ''")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS reminders ("
+            "slot TEXT, user_id TEXT, umo TEXT, reminder TEXT, PRIMARY KEY (slot, user_id, reminder))")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "user_id TEXT PRIMARY KEY, term TEXT, week INTEGER, digest TEXT, courses TEXT, "
+            "checked_at REAL, interval REAL)")
+        if legacy_ini:
+            self.import_ini(legacy_ini)
+    def import_ini(self, ini_path):
+        '''
+        导入旧的 user.ini，只在第一次启动时执行
+        :param ini_path: user.ini 路径
+        '''
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'ini_imported'").fetchone():
+            return
+        users = {}
+        if os.path.exists(ini_path):
+            user_config = configparser.ConfigParser()
+            user_config.read(ini_path, encoding='utf-8')
+            for user_id in user_config.sections():
+                section = user_config[user_id]
+                if section.get('User', '') and section.get('Password', ''):
+                    users[user_id] = {
+                        'platform': section.get('Platform', ''),
+                        'umo': section.get('UMO', ''),
+                        'user': section.get('User', ''),
+                        'password': section.get('Password', ''),
+                        'status': section.get('status', '1'),
+                        'mode': 'image',
+                    }
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for user_id, info in users.items():
+                self._upsert(user_id, info)
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('ini_imported', ?)", (datetime.now().isoformat(),))
+        if users:
+            logger.info(f"已从 {ini_path} 导入 {len(users)} 个用户到 {self.path}")
+    def load_all(self):
+        '''
+        读取所有用户
+        :return: {用户ID: 用户信息}
+        '''
+        rows = self.conn.execute(f"SELECT user_id, {', '.join(self.FIELDS)} FROM users").fetchall()
+        return {row[0]: dict(zip(self.FIELDS, row[1:])) for row in rows}
+    def _upsert(self, user_id, info):
+        self.conn.execute(
+            f"INSERT INTO users (user_id, {', '.join(self.FIELDS)}) VALUES (?{', ?' * len(self.FIELDS)}) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {', '.join(f'{field} = excluded.{field}' for field in self.FIELDS)}",
+            (user_id, *(info.get(field) or self.DEFAULTS.get(field, '') for field in self.FIELDS)))
+    def upsert(self, user_id, info):
+        '''
+        新增或更新单个用户
+        :param user_id: 用户ID
+        :param info: 用户信息
+        '''
+        self._upsert(user_id, info)
+    def delete(self, user_id):
+        '''
+        删除单个用户
+        :param user_id: 用户ID
+        '''
+        self.conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        self.delete_snapshot(user_id)
+    def add_reminder(self, slot, user_id, umo, reminder):
+        '''
+        保存一条待发送的提醒
+        :param slot: 触发时间
+        :param user_id: 用户ID
+        :param umo: 消息来源
+        :param reminder: 提醒内容
+        '''
+        self.conn.execute(
+            "INSERT OR IGNORE INTO reminders (slot, user_id, umo, reminder) VALUES (?, ?, ?, ?)",
+            (slot.isoformat(), user_id, umo, reminder))
+    def load_reminders(self):
+        '''
+        读取所有待发送的提醒
+        :return: [(触发时间, 用户ID, 消息来源, 提醒内容)]
+        '''
+        rows = self.conn.execute("SELECT slot, user_id, umo, reminder FROM reminders").fetchall()
+        return [(datetime.fromisoformat(slot), user_id, umo, reminder) for slot, user_id, umo, reminder in rows]
+    def delete_reminders(self, slot):
+        '''
+        删除某个时段的提醒
+        :param slot: 触发时间
+        '''
+        self.conn.execute("DELETE FROM reminders WHERE slot = ?", (slot.isoformat(),))
+    def delete_reminders_before(self, slot):
+        '''
+        删除某个时间之前的提醒
+        :param slot: 时间
+        '''
+        self.conn.execute("DELETE FROM reminders WHERE slot < ?", (slot.isoformat(),))
+    def load_snapshots(self):
+        '''
+        读取所有用户的课表快照
+        :return: {用户ID: TimetableSnapshot}
+        '''
+        rows = self.conn.execute(
+            "SELECT user_id, term, week, digest, courses, checked_at, interval FROM snapshots").fetchall()
+        snapshots = {}
+        for user_id, term, week, digest, courses, checked_at, interval in rows:
             try:
-                os.remove(temp_file_path)
-            except Exception as e:
-                logger.error(f"删除临时文件失败: {e}")
-    async def get_courses(self):
+                courses = tuple(Course(*row) for row in json.loads(courses))
+            except (TypeError, ValueError):
+                continue
+            snapshots[user_id] = TimetableSnapshot(term, week, digest, courses, checked_at, interval)
+        return snapshots
+    def delete_snapshot(self, user_id):
         '''
-        获取课程信息
-        :return: 返回课程信息
+        删除单个用户的课表快照
+        :param user_id: 用户ID
         '''
-        encoded_str = f"{self.to_base64(self.username)}%%%{self.to_base64(self.password)}"
-        today = datetime.now().strftime("%Y-%m-%d")
-
-        headers = {
-            'Host': 'qzjwpc.cqvtu.edu.cn',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': 'https://qzjwpc.cqvtu.edu.cn',
-            'Referer': 'https://qzjwpc.cqvtu.edu.cn/jsxsd/xk/LoginToXk',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36 Edg/137.0.0.0',
-        }
-        data = {
-            'loginMethod': "LoginToXk",
-            'userAccount': self.username,
-            'userPassword': self.password,
-            'encoded': encoded_str,
-        }
-
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.post(self.LOGIN_URL, headers=headers, data=data) as login_response:
-                    await login_response.text()
-
-                timetable_url = self.TIMETABLE_URL_FORMAT.format(date=today)
-                async with session.get(timetable_url, headers=headers) as timetable_response:
-                    html_content = await timetable_response.text()
-                weeks, today_courses, today_reminder = await self.get_daily_timetable(html_content)
-                return today_courses, weeks, today_reminder
-            except Exception as e:
-                logger.error(f"获取课表失败: {e}")
-                return "获取课表失败"
-    async def get_daily_timetable(self, html_content):
+        self.conn.execute("DELETE FROM snapshots WHERE user_id = ?", (user_id,))
+    def save_snapshot(self, user_id, snapshot):
         '''
-        获取每日课表
-        :param html_content: HTML内容
-        :return: 返回周数、今日课程、今日提醒
+        保存单个用户的课表快照
+        :param user_id: 用户ID
+        :param snapshot: TimetableSnapshot
         '''
-        parser = html.HTMLParser()
-        root = html.fromstring(html_content, parser=parser)
-
-        color_to_course_type = {
-            'rgb(251, 194, 194)': '必修',
-            'rgb(205, 221, 252)': '限选',
-            'rgb(190, 237, 242)': '任选',
-            'rgb(252, 217, 181)': '公选',
-            'rgb(247, 247, 248)': '其它'
-        }
-
-        time_slot_mapping = {
-            "第一二节": "8:30-10:00",
-            "第三四节": "10:20-11:50",
-            "第五六节": "14:00-15:30",
-            "第七八节": "15:50-17:20",
-            "第九十节": "18:30-20:00"
-        }
-        time_slot_mapping_begin = {
-            "第一二节": "8:00",
-            "第三四节": "9:50",
-            "第五六节": "13:30",
-            "第七八节": "15:20",
-            "第九十节": "18:00"
-        }
-        timetable = []
-        for row in root.xpath('//table[@id="timetable"]/tbody/tr'):
-            if not row.xpath('td[1]/text()'):
-                continue
-            time_slot = row.xpath('td[1]/text()')[0].strip()
-            specific_time = time_slot_mapping.get(time_slot, time_slot)
-            reminder_time = time_slot_mapping_begin.get(time_slot, time_slot)
-            for day_index in range(1, 8):
-                course_td = row.xpath(f'td[{day_index + 1}]')
-                if not course_td or not course_td[0].text_content().strip():
-                    continue
-                course_td = course_td[0]
-
-                course_name = course_td.xpath('.//div[@class="item-box"]/p[1]/text()')
-                course_name = course_name[0].strip() if course_name else ''
-                teacher = course_td.xpath('.//div[@class="tch-name"]/span[1]/text()')
-                teacher = teacher[0].strip().replace('教师：', '') if teacher else ''
-                location = course_td.xpath('.//div//span[img/@src="/jsxsd/assets_v1/images/item1.png"]/text()')
-                location = location[0].strip() if location else ''
-
-                color_span = course_td.xpath('.//span[@class="box"]')
-                course_type = ''
-                if color_span:
-                    style = color_span[0].get('style', '')
-                    color_pattern = r'background-color:\s*rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)'
-                    match = re.search(color_pattern, style)
-                    if match:
-                        rgb_color = f"rgb({match.group(1)}, {match.group(2)}, {match.group(3)})"
-                        course_type = color_to_course_type.get(rgb_color, '')
-
-                course_data = {
-                    'time_slot': specific_time,
-                    'day': day_index,
-                    'course_name': course_name,
-                    'teacher': teacher,
-                    'location': location,
-                    'course_type': course_type,
-                    'reminder_time': reminder_time,
-                    'reminder': f"提醒:\n{specific_time}\n请准备前往 {location},即将开始 {course_name} ({teacher}老师)的课程。"
-                }
-                timetable.append(course_data)
-
-        start_date = datetime.strptime(self.start_date_str, '%Y-%m-%d')
-        now = datetime.strptime(datetime.now().strftime("%Y-%m-%d"), '%Y-%m-%d')
-        weeks = (now - start_date).days // 7 + 1
-        today = datetime.today().isoweekday()
-        today_courses = [course for course in timetable if course['day'] == today]
-        today_reminder = [{key: course[key] for key in ['reminder_time', 'reminder']} for course in timetable if
-                          course['day'] == today]
-        return weeks, today_courses, today_reminder
-    async def html_to_image(self, html_content, output_path):
-        """将 HTML 内容渲染为图片，使用 Edge 浏览器"""
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self._generate_image, html_content, output_path)
-    async def json_to_markdown(self, course_data):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO snapshots (user_id, term, week, digest, courses, checked_at, interval) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, snapshot.term, snapshot.week, snapshot.digest,
+             json.dumps([list(course) for course in snapshot.courses], ensure_ascii=False),
+             snapshot.checked_at, snapshot.interval))
+    def close(self):
         '''
-        将课程数据转换为Markdown格式
-        :param course_data: 课程数据
-        :return: Markdown格式的字符串
+        关闭数据库
         '''
-        markdown = "|-----------时间段----------|\n|------课程名称------| 教师 |\n|-------地点------| 课程类型 |\n"
-        for course in course_data:
-            markdown += f"|--------{course['time_slot']}-------|\n| {course['course_name']} | {course['teacher']} |\n|------{course['location']}-----| {course['course_type']} |\n"
-        return markdown
-    async def generate_schedule_image(self, courses, weeks, output_path):
-        """生成课程表 HTML 并渲染为图片"""
-        # 构建数据字典
-        data = {
-            "weeks": weeks,
-            "day": self.num_map.get(courses[0]["day"], "未知"),
-            "courses": courses
-        }
-        # 渲染 HTML
-        rendered_html = self.render_template(self.TMPL, data)
-
-        # 生成图片
-        await self.html_to_image(rendered_html, output_path)
+        self.conn.close()
 
 @register("course_query", "CHIYUAN", "查询每日课表", "1.0.2", "https://github.com/yourrepo")
 class CourseQueryPlugin(Star):
+    # 用户数据库路径
+    USER_DB_PATH = 'user.db'
+    # 浏览器池大小
+    BROWSER_POOL_SIZE = 2
+    # 单个浏览器实例渲染多少次后回收重建
+    BROWSER_MAX_RENDERS = 50
+    # 教务系统请求速率（每秒）和突发上限
+    UPSTREAM_RATE = 5
+    UPSTREAM_BURST = 10
+    # 教务系统连接、读取超时（秒）和失败重试次数
+    UPSTREAM_CONNECT_TIMEOUT = 5
+    UPSTREAM_READ_TIMEOUT = 15
+    UPSTREAM_RETRIES = 2
+    # 连续失败多少次后熔断，以及熔断持续时间（秒）
+    BREAKER_THRESHOLD = 5
+    BREAKER_RESET_TIMEOUT = 60
+    # 课表缓存容量、过期时间（秒）和持久化文件
+    TIMETABLE_CACHE_SIZE = 1024
+    TIMETABLE_CACHE_TTL = 12 * 3600
+    TIMETABLE_CACHE_PATH = 'timetable_cache.json'
+    # 学期配置文件，包含各学期、校区和作息时间，修改后在下次预取时自动重新加载
+    TERMS_PATH = os.environ.get("COURSE_TERMS_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'terms.json')
+    # 课表图片缓存目录和占用上限（字节）
+    RENDER_CACHE_DIR = 'render_cache'
+    RENDER_CACHE_MAX_BYTES = 200 * 1024 * 1024
+    # 渲染后端：selenium 使用无头 Edge 截图，pillow 直接绘制，auto 在找不到 msedgedriver 时使用 pillow，
+    # 也找不到中文字体时改为以文字推送
+    RENDER_BACKEND = "auto"
+    # 每日推送前预取课表的时间，以及对失败账号的提前重试时间
+    PREFETCH_HOUR, PREFETCH_MINUTE = 6, 30
+    PREFETCH_RETRY_HOUR, PREFETCH_RETRY_MINUTE = 7, 30
+    # 提醒错过触发时间（如插件重启期间）后仍补发的宽限期（秒）
+    REMINDER_MISFIRE_GRACE = 15 * 60
+    # 定期导出 Prometheus 文本格式统计的文件路径，为空时不导出
+    METRICS_DUMP_PATH = None
+    METRICS_DUMP_INTERVAL = 60
+    # 每日推送各阶段的并发上限
+    DAILY_FETCH_CONCURRENCY = 8
+    DAILY_RENDER_CONCURRENCY = BROWSER_POOL_SIZE
+    # 每日推送各阶段的单用户超时时间（秒）
+    DAILY_FETCH_TIMEOUT = 30
+    DAILY_RENDER_TIMEOUT = 60
+    # 整批推送的时间预算（秒），需在 8:30 第一节课前完成
+    DAILY_BUDGET = 20 * 60
+    # 出站消息队列：各平台每秒发送条数（按消息来源中的平台ID区分），未列出的平台使用默认速率；
+    # 每个平台的工作协程数、单次发送超时（秒）、失败重试次数和退避基准时间（秒）
+    DELIVERY_RATES = {'aiocqhttp': 5, 'wechatpadpro': 1, 'lark': 10}
+    DELIVERY_DEFAULT_RATE = 5
+    DELIVERY_WORKERS = 2
+    DELIVERY_TIMEOUT = 15
+    DELIVERY_RETRIES = 3
+    DELIVERY_BACKOFF = 2
+    # 班级分组：课表完全相同的账号归为一组，只通过代表账号获取；组员平均每隔 CLASS_GROUP_VERIFY_INTERVAL 秒
+    # 自行获取一次校验，课程数少于 CLASS_GROUP_MIN_COURSES 的课表不参与分组，强制刷新时共用代表账号多久以内的课表（秒）
+    CLASS_GROUP_VERIFY_INTERVAL = 3 * 24 * 3600
+    CLASS_GROUP_MIN_COURSES = 3
+    CLASS_GROUP_REFRESH_AGE = 10 * 60
+    # 课表变动检测：轮询节拍（秒）、单个用户检测间隔的上下限（秒）、每个节拍最多检测的用户数和并发数，
+    # 课表没有变化时检测间隔逐次翻倍，检测到变动后回到下限；只在 CHANGE_POLL_HOURS 时段内检测
+    CHANGE_POLL_TICK = 10 * 60
+    CHANGE_POLL_MIN_INTERVAL = 30 * 60
+    CHANGE_POLL_MAX_INTERVAL = 8 * 3600
+    CHANGE_POLL_BATCH = 20
+    CHANGE_POLL_CONCURRENCY = 2
+    CHANGE_POLL_HOURS = (7, 22)
+    # 课表推送模式：image 发送图片，text 只发送文字（不渲染图片），both 两者都发
+    DELIVERY_MODES = {'图片': 'image', '文字': 'text', '全部': 'both', 'image': 'image', 'text': 'text', 'both': 'both'}
+    DELIVERY_MODE_NAMES = {'image': '图片', 'text': '文字', 'both': '全部'}
+    DEFAULT_DELIVERY_MODE = 'image'
+    # 审计日志和用户反馈（JSON Lines，不含密码）：单个文件的大小上限（字节）和保留的历史文件数，
+    # 定期写盘的间隔（秒）和立即写盘的缓冲条数；单条反馈最多保留多少字
+    AUDIT_LOG_PATH = 'audit.jsonl'
+    FEEDBACK_LOG_PATH = 'feedback.jsonl'
+    LOG_MAX_BYTES = 5 * 1024 * 1024
+    LOG_BACKUPS = 3
+    LOG_FLUSH_INTERVAL = 2
+    LOG_BATCH_SIZE = 100
+    FEEDBACK_MAX_CHARS = 1000
     def __init__(self, context: Context):
         """
         初始化
@@ -354,86 +2506,205 @@ class CourseQueryPlugin(Star):
         """
         super().__init__(context)
         self.user = {}  # 使用字典存储用户信息，键为用户ID，值为绑定的User和Password
-        self.scheduler = AsyncIOScheduler()  # 创建调度器
+        # 用户信息持久化存储，首次启动时导入 user.ini
+        self.user_store = UserStore(self.USER_DB_PATH, legacy_ini='user.ini')
+        self.scheduler = None  # 调度器在 initialize 中创建，加载插件时不导入 apscheduler
+        self._images_available = None  # 首次需要图片时才检查渲染后端，加载插件时不导入 PIL
         self.course_fetcher = None
         self.message_sender = None
+        # 预取阶段准备好的今日课表，键为用户ID
+        self.prepared = {}
+        # 按触发时间分组的课程提醒，{触发时间: {(用户ID, 提醒内容): 消息来源}}
+        self.reminder_slots = {}
+        # 变动检测用的课表快照，{用户ID: TimetableSnapshot}
+        self.snapshots = {}
+        # 学期日历，所有 CourseFetcher 共享
+        self.terms = TermRegistry(self.TERMS_PATH)
+        # 常驻浏览器池，所有 CourseFetcher 共享，实例（以及 selenium）在首次渲染时才加载
+        self.browser_pool = BrowserPool(
+            CourseFetcher.default_driver_path(),
+            size=self.BROWSER_POOL_SIZE,
+            max_renders=self.BROWSER_MAX_RENDERS,
+        )
+        # 共享连接池和按账号缓存的登录会话
+        self.session_manager = SessionManager(
+            rate=self.UPSTREAM_RATE,
+            burst=self.UPSTREAM_BURST,
+            connect_timeout=self.UPSTREAM_CONNECT_TIMEOUT,
+            read_timeout=self.UPSTREAM_READ_TIMEOUT,
+            retries=self.UPSTREAM_RETRIES,
+            breaker=CircuitBreaker(self.BREAKER_THRESHOLD, self.BREAKER_RESET_TIMEOUT),
+        )
+        # 整周课表缓存，多数查询无需访问教务系统
+        self.timetable_cache = TimetableCache(
+            maxsize=self.TIMETABLE_CACHE_SIZE,
+            ttl=self.TIMETABLE_CACHE_TTL,
+            path=self.TIMETABLE_CACHE_PATH,
+        )
+        # 合并同一账号的并发课表请求
+        self.single_flight = SingleFlight()
+        # 按平台分队列的出站消息，各平台独立限速和重试
+        self.delivery_queue = DeliveryQueue(
+            self.context.send_message,
+            rates=self.DELIVERY_RATES,
+            default_rate=self.DELIVERY_DEFAULT_RATE,
+            workers=self.DELIVERY_WORKERS,
+            timeout=self.DELIVERY_TIMEOUT,
+            retries=self.DELIVERY_RETRIES,
+            backoff=self.DELIVERY_BACKOFF,
+        )
+        # 同班账号共用一次获取
+        self.class_groups = ClassGroups(
+            verify_interval=self.CLASS_GROUP_VERIFY_INTERVAL,
+            min_courses=self.CLASS_GROUP_MIN_COURSES,
+            refresh_age=self.CLASS_GROUP_REFRESH_AGE,
+        )
+        # 按内容哈希缓存的课表图片，同班同学的相同课表只渲染一次
+        self.render_cache = RenderCache(self.RENDER_CACHE_DIR, max_bytes=self.RENDER_CACHE_MAX_BYTES)
+        # 订阅变更的审计记录和用户反馈，缓冲后成批写盘，不阻塞事件循环
+        self.audit_log = self.new_log(self.AUDIT_LOG_PATH)
+        self.feedback_log = self.new_log(self.FEEDBACK_LOG_PATH)
 
     async def initialize(self):
         """在插件初始化后调用"""
         try:
+            self.ensure_scheduler()
             # 加载配置
             self.load_config()
             logger.info("配置加载成功")
+            # 恢复重启前安排的课程提醒，任务在启动调度器时重新创建
+            self.restore_reminders()
             # 启动定时任务
             self.start_scheduler()
 
             logger.info("插件初始化完成")
         except Exception as e:
             logger.error(f"插件初始化失败: {e}")
+    def new_fetcher(self, user_info):
+        """
+        为用户创建课程处理对象，共享插件持有的学期日历、浏览器池、会话、缓存和请求合并器
+        :param user_info: 用户信息
+        :return: CourseFetcher
+        """
+        return CourseFetcher(
+            user_info['user'], user_info['password'], self.terms,
+            browser_pool=self.browser_pool,
+            session_manager=self.session_manager,
+            timetable_cache=self.timetable_cache,
+            render_cache=self.render_cache,
+            render_backend=self.RENDER_BACKEND,
+            single_flight=self.single_flight,
+            campus=user_info.get('campus') or None,
+            class_groups=self.class_groups,
+        )
+
+    def new_log(self, path):
+        """
+        创建追加写入的日志
+        :param path: 日志文件路径
+        :return: AuditLog
+        """
+        return AuditLog(
+            path,
+            max_bytes=self.LOG_MAX_BYTES,
+            backups=self.LOG_BACKUPS,
+            flush_interval=self.LOG_FLUSH_INTERVAL,
+            batch_size=self.LOG_BATCH_SIZE,
+        )
+
     def load_config(self):
         """
         加载用户配置
         """
-        # 加载 user.ini
-        if os.path.exists('user.ini'):
-            user_config = configparser.ConfigParser()
-            user_config.read('user.ini', encoding='utf-8')
-            for user_id in user_config.sections():
-                platform = user_config[user_id].get('Platform', '')
-                umo = user_config[user_id].get('UMO', '')
-                user = user_config[user_id].get('User', '')
-                password = user_config[user_id].get('Password', '')
-                status = user_config[user_id].get('status', '1')
-
-                if user and password:
-                    self.user[user_id] = {
-                        'platform': platform,
-                        'umo': umo,
-                        'user': user,
-                        'password': password,
-                        'status': status,
-                    }
-                    logger.info(
-                        f"从 user.ini 加载用户: {user_id}, User: {user}, Password: {password}, Platform: {platform}")
+        self.user = self.user_store.load_all()
+        self.snapshots = self.user_store.load_snapshots()
+        logger.info(f"从 {self.user_store.path} 加载 {len(self.user)} 个用户")
+        for user_id, info in self.user.items():
+            logger.debug(f"加载用户: {user_id}, User: {info['user']}, Platform: {info['platform']}")
 
-    def save_user_config(self):
+    def save_user_config(self, user_id):
         """
-        保存用户配置
+        保存单个用户的配置，用户已被删除时从存储中移除
+        :param user_id: 用户ID
         """
-        # 保存 user.ini
-        config = configparser.ConfigParser()
-        for user_id, info in self.user.items():
-            config[user_id] = {
-                'Platform': info['platform'],
-                'UMO': info['umo'],
-                'User': info['user'],
-                'Password': info['password'],
-                'status': info['status'],
-            }
-        with open('user.ini', 'w', encoding='utf-8') as configfile:
-            config.write(configfile)
-        logger.info(f"保存了 {len(self.user)} 个用户到 user.ini")
+        if user_id in self.user:
+            self.user_store.upsert(user_id, self.user[user_id])
+        else:
+            self.snapshots.pop(user_id, None)
+            self.user_store.delete(user_id)
+
+    async def forget_account(self, username, password):
+        """
+        账号的这个密码不再被任何用户使用时关闭其登录会话；账号不再被使用时清除其班级分组信息，不再用它代为获取课表
+        :param username: 教务系统账号
+        :param password: 密码
+        """
+        if not any(info['user'] == username and info['password'] == password for info in self.user.values()):
+            await self.session_manager.discard(username, password)
+        if not any(info['user'] == username for info in self.user.values()):
+            self.class_groups.forget(username)
+
+    def ensure_scheduler(self):
+        """
+        创建调度器，只在第一次调用时导入 apscheduler
+        :return: 调度器
+        """
+        if self.scheduler is None:
+            from apscheduler.schedulers.asyncio import AsyncIOScheduler
+            self.scheduler = AsyncIOScheduler()
+        return self.scheduler
 
     def start_scheduler(self):
         """
         启动定时任务
         """
+        from apscheduler.triggers.cron import CronTrigger
+        from apscheduler.triggers.interval import IntervalTrigger
+        self.ensure_scheduler()
         if self.scheduler.running:
             self.scheduler.remove_all_jobs()
+        self.scheduler.add_job(
+            self.prefetch_daily_course,
+            CronTrigger(hour=self.PREFETCH_HOUR, minute=self.PREFETCH_MINUTE, second=0),
+            id="daily_course_prefetch",
+            name="每日课表预取"
+        )
+        self.scheduler.add_job(
+            self.prefetch_daily_course,
+            CronTrigger(hour=self.PREFETCH_RETRY_HOUR, minute=self.PREFETCH_RETRY_MINUTE, second=0),
+            id="daily_course_prefetch_retry",
+            name="每日课表预取重试",
+            kwargs={'only_missing': True}
+        )
         self.scheduler.add_job(
             self.send_daily_course,
             CronTrigger(hour=7, minute=55, second=0),
             id="daily_course_reminder",
             name="每日课程提醒"
         )
+        if self.CHANGE_POLL_TICK:
+            self.scheduler.add_job(
+                self.poll_timetable_changes,
+                IntervalTrigger(seconds=self.CHANGE_POLL_TICK),
+                id="timetable_change_poll",
+                name="课表变动检测"
+            )
+        if self.METRICS_DUMP_PATH:
+            self.scheduler.add_job(
+                self.dump_metrics,
+                IntervalTrigger(seconds=self.METRICS_DUMP_INTERVAL),
+                id="metrics_dump",
+                name="导出性能统计"
+            )
         self.scheduler.start()
+        self.reschedule_reminder_slots()
         logger.info("定时任务已启动")
 
     def stop_scheduler(self):
         """
         停止定时任务
         """
-        if self.scheduler.running:
+        if self.scheduler is not None and self.scheduler.running:
             self.scheduler.shutdown()
             logger.info("定时任务已停止")
 
@@ -441,82 +2712,420 @@ class CourseQueryPlugin(Star):
         """在插件卸载时调用"""
         try:
             self.stop_scheduler()
-            # 保存用户配置
-            self.save_user_config()
+            # 关闭浏览器池
+            await asyncio.get_event_loop().run_in_executor(None, self.browser_pool.shutdown)
+            # 发完队列中剩余的消息
+            await self.delivery_queue.close()
+            # 写入缓冲中的审计记录和反馈
+            await self.audit_log.close()
+            await self.feedback_log.close()
+            # 关闭登录会话和连接池
+            await self.session_manager.close()
+            # 持久化课表缓存
+            await self.timetable_cache.persist()
+            # 用户配置已逐条写入，这里只需关闭数据库
+            self.user_store.close()
 
             logger.info("插件已成功卸载")
         except Exception as e:
             logger.error(f"插件卸载失败: {e}")
-    async def send_reminder(self, user_id, user_info, job_id, reminder):
+    async def send_message(self, umo, message_chain):
+        """
+        通过出站队列主动发送消息，按平台限速，失败时自动重试
+        :param umo: 消息来源
+        :param message_chain: 消息链
+        :return: 是否送达
+        """
+        return await self.delivery_queue.deliver(umo, message_chain)
+
+    @staticmethod
+    def reminder_slot_job_id(slot):
         """
-        发送提醒
+        时段提醒任务的ID
+        :param slot: 触发时间
+        :return: 任务ID
+        """
+        return f"reminder_slot_{slot:%Y%m%d%H%M}"
+
+    def schedule_reminder(self, user_id, umo, slot, reminder):
+        """
+        将提醒放入对应时段的队列，每个时段只创建一个定时任务；
+        同一用户同一时段的相同提醒只保留一条
         :param user_id: 用户ID
-        :param user_info: 用户信息
-        :param job_id: 任务ID
+        :param umo: 消息来源
+        :param slot: 触发时间
         :param reminder: 提醒内容
+        :return: 是否新增了提醒
         """
-        message_chain = MessageChain().message(reminder)
-        await self.context.send_message(user_info['umo'], message_chain)
-        self.scheduler.remove_job(job_id)
-        jobs = self.scheduler.get_jobs()
-        logger.info(f"当前调度器内的任务数量：{len(jobs)}")
-        for job in jobs:
-            logger.info(f"任务ID：{job.id}, 任务名称：{job.name}, 下次运行时间：{job.next_run_time}")
-        logger.info(f"向用户 {user_id} 发送提醒: {reminder}成功")
+        bucket = self.reminder_slots.setdefault(slot, {})
+        key = (user_id, reminder)
+        if key in bucket:
+            return False
+        bucket[key] = umo
+        # 持久化，插件重启后仍能恢复
+        self.user_store.add_reminder(slot, user_id, umo, reminder)
+        self.add_reminder_slot_job(slot)
+        return True
+
+    def add_reminder_slot_job(self, slot):
+        """
+        为时段创建提醒任务，已过时但仍在宽限期内的时段立即触发
+        :param slot: 触发时间
+        """
+        from apscheduler.triggers.date import DateTrigger
+        job_id = self.reminder_slot_job_id(slot)
+        if self.ensure_scheduler().get_job(job_id):
+            return
+        self.scheduler.add_job(
+            self.send_reminder_slot,
+            DateTrigger(run_date=max(slot, datetime.now())),
+            id=job_id,
+            name=f"课程提醒: {slot:%H:%M}",
+            args=[slot],
+            misfire_grace_time=self.REMINDER_MISFIRE_GRACE
+        )
+        logger.info(f"创建时段提醒任务 {job_id}")
+
+    def reschedule_reminder_slots(self):
+        """
+        调度器重启后为尚未发送的时段重新创建任务
+        """
+        for slot in list(self.reminder_slots):
+            self.add_reminder_slot_job(slot)
+
+    def restore_reminders(self):
+        """
+        从存储中恢复重启前安排的提醒，超过宽限期的提醒丢弃并记录，不重新获取课表
+        """
+        now = datetime.now()
+        restored = expired = 0
+        for slot, user_id, umo, reminder in self.user_store.load_reminders():
+            if (now - slot).total_seconds() > self.REMINDER_MISFIRE_GRACE:
+                expired += 1
+                continue
+            self.reminder_slots.setdefault(slot, {})[(user_id, reminder)] = umo
+            restored += 1
+        if expired:
+            self.user_store.delete_reminders_before(now - timedelta(seconds=self.REMINDER_MISFIRE_GRACE))
+            logger.warning(f"有 {expired} 条提醒在插件停止期间已超过宽限期，已丢弃")
+        logger.info(f"从存储中恢复了 {restored} 条课程提醒，共 {len(self.reminder_slots)} 个时段")
+
+    async def send_reminder_slot(self, slot):
+        """
+        发送某一时段内所有用户的提醒
+        :param slot: 触发时间
+        """
+        bucket = self.reminder_slots.pop(slot, {})
+        if not bucket:
+            return
+        # 出站队列按平台限速和重试，这里只需全部提交
+        results = await asyncio.gather(
+            *[self.send_message(umo, MessageChain().message(reminder)) for (user_id, reminder), umo in bucket.items()])
+        self.user_store.delete_reminders(slot)
+        logger.info(f"{slot:%H:%M} 时段提醒发送完成: 成功 {sum(results)} 条，失败 {len(results) - sum(results)} 条")
+
+    async def poll_timetable_changes(self):
+        """
+        课表变动检测：为到期的订阅用户重新获取本周课表，与上次的快照比较，有变动时只推送差异
+        """
+        now = datetime.now()
+        if not self.CHANGE_POLL_HOURS[0] <= now.hour < self.CHANGE_POLL_HOURS[1]:
+            return
+        current = time.time()
+        due = []
+        for user_id, user_info in self.user.copy().items():
+            if user_info.get("status") == "0":
+                continue
+            snapshot = self.snapshots.get(user_id)
+            next_check = snapshot.checked_at + snapshot.interval if snapshot else 0
+            if next_check <= current:
+                due.append((next_check, user_id, user_info))
+        if not due:
+            return
+        # 每个节拍只检测最久未检测的一批用户，把请求分散开
+        due.sort(key=lambda item: item[0])
+        due = due[:self.CHANGE_POLL_BATCH]
+        semaphore = asyncio.Semaphore(self.CHANGE_POLL_CONCURRENCY)
+        results = await asyncio.gather(
+            *[self.check_timetable_change(user_id, user_info, semaphore) for _, user_id, user_info in due],
+            return_exceptions=True)
+        changed = 0
+        for (_, user_id, _), result in zip(due, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"检测用户 {user_id} 的课表变动失败: {result!r}")
+            elif result:
+                changed += 1
+        logger.info(f"课表变动检测完成: 检测 {len(due)} 个用户，{changed} 个有变动")
+
+    async def check_timetable_change(self, user_id, user_info, semaphore):
+        """
+        检测单个用户的本周课表是否有变动
+        :param user_id: 用户ID
+        :param user_info: 用户信息
+        :param semaphore: 并发限制
+        :return: 是否检测到变动并已通知
+        """
+        async with semaphore:
+            course_fetcher = self.new_fetcher(user_info)
+            with metrics.stage("change_check"):
+                week = await asyncio.wait_for(
+                    course_fetcher.get_week_timetable(force_refresh=True), timeout=self.DAILY_FETCH_TIMEOUT)
+        term = course_fetcher.term_for()
+        digest = timetable_digest(week.courses)
+        previous = self.snapshots.get(user_id)
+        changes = []
+        if previous is None or (previous.term, previous.week) != (term.key, week.weeks):
+            # 首次检测或进入新的一周，只记录基准，不通知
+            interval = previous.interval if previous else self.CHANGE_POLL_MIN_INTERVAL
+        elif previous.digest == digest:
+            interval = min(previous.interval * 2, self.CHANGE_POLL_MAX_INTERVAL)
+        else:
+            interval = self.CHANGE_POLL_MIN_INTERVAL
+            changes = diff_courses(previous.courses, week.courses, since_day=datetime.today().isoweekday())
+            # 预取的今日课表已经过时
+            self.prepared.pop(user_id, None)
+        snapshot = TimetableSnapshot(term.key, week.weeks, digest, week.courses, time.time(), interval)
+        self.snapshots[user_id] = snapshot
+        self.user_store.save_snapshot(user_id, snapshot)
+        if not changes:
+            return False
+        logger.info(f"用户 {user_id} 的课表有 {len(changes)} 处变动")
+        message_chain = MessageChain().message(f"课表变动提醒（第 {week.weeks} 周）：\n" + "\n".join(changes))
+        return await self.send_message(user_info['umo'], message_chain)
 
     async def send_daily_course(self):
         """
-        发送每日课程
+        发送每日课程，登录/获取和渲染阶段分别限制并发，发送交给按平台限速的出站队列，
+        单个用户的失败和超时不影响其他用户
         """
         if not self.user:
             logger.info("没有用户开启课程提醒，跳过发送。")
             return
         logger.info("开始获取今日课程信息")
         try:
+            limits = self.new_stage_limits()
+            tasks = {}
             for user_id, user_info in self.user.copy().items():
                 if user_info.get("status") == "0":
                     logger.info(f"用户 {user_id} 未开启订阅，跳过发送课程信息。")
                     continue
+                task = asyncio.ensure_future(self.send_daily_course_to_user(user_id, user_info, limits))
+                tasks[task] = user_id
+            if not tasks:
+                return
+            started = time.monotonic()
+            done, pending = await asyncio.wait(tasks, timeout=self.DAILY_BUDGET)
+            metrics.observe("daily_batch", time.monotonic() - started, error=bool(pending))
+            for task in pending:
+                task.cancel()
+                logger.error(f"用户 {tasks[task]} 的课表推送超出整体时间预算 {self.DAILY_BUDGET} 秒，已取消")
+            if pending:
+                await asyncio.wait(pending)
+            logger.info(
+                f"每日课表推送完成: 共 {len(tasks)} 个用户，完成 {len(done)} 个，"
+                f"超时取消 {len(pending)} 个，耗时 {time.monotonic() - started:.1f} 秒")
+            await self.timetable_cache.persist()
+        except Exception as e:
+            logger.error(f"获取课程信息失败: {e}")
+
+    def new_stage_limits(self):
+        """
+        创建各阶段的并发限制，信号量需在事件循环内创建
+        :return: 各阶段的信号量
+        """
+        return {
+            'fetch': asyncio.Semaphore(self.DAILY_FETCH_CONCURRENCY),
+            'render': asyncio.Semaphore(self.DAILY_RENDER_CONCURRENCY),
+        }
+
+    async def prefetch_daily_course(self, only_missing=False):
+        """
+        在每日推送前预先获取、解析并渲染所有订阅用户的课表，推送时只需发送
+        :param only_missing: 只处理尚未准备好的用户，用于提前重试失败的账号
+        """
+        # 学期配置有修改时先重新加载，新学期无需重启
+        self.terms.reload_if_changed()
+        today = datetime.now().date()
+        # 丢弃前一天未发送的结果
+        for user_id in [uid for uid, prepared in self.prepared.items() if prepared['date'] != today]:
+            del self.prepared[user_id]
+        targets = {
+            user_id: user_info for user_id, user_info in self.user.copy().items()
+            if user_info.get("status") != "0" and not (only_missing and user_id in self.prepared)
+        }
+        if not targets:
+            return
+        logger.info(f"开始预取 {len(targets)} 个用户的课表")
+        limits = self.new_stage_limits()
+        results = await asyncio.gather(
+            *[self.prepare_daily_course(user_id, user_info, limits, force_refresh=not only_missing)
+              for user_id, user_info in targets.items()],
+            return_exceptions=True)
+        failed = 0
+        for (user_id, _), result in zip(targets.items(), results):
+            if isinstance(result, BaseException):
+                failed += 1
+                logger.error(f"预取用户 {user_id} 的课表失败，将在推送前重试: {result!r}")
+            else:
+                self.prepared[user_id] = result
+        await self.timetable_cache.persist()
+        logger.info(f"课表预取完成: 成功 {len(targets) - failed} 个，失败 {failed} 个")
+
+    async def prepare_daily_course(self, user_id, user_info, limits, force_refresh=False):
+        """
+        获取并渲染单个用户的今日课表
+        :param user_id: 用户ID
+        :param user_info: 用户信息
+        :param limits: 各阶段的信号量
+        :param force_refresh: 是否跳过课表缓存
+        :return: 准备好的今日课表
+        """
+        course_fetcher = self.new_fetcher(user_info)
+        week = await self.run_stage(
+            limits, 'fetch', self.DAILY_FETCH_TIMEOUT, course_fetcher.get_week_timetable(force_refresh=force_refresh))
+        weeks, courses, reminders = course_fetcher.select_day(week)
+        mode = self.delivery_mode(user_info)
+        png = text = None
+        if courses:
+            # 文字模式完全跳过图片渲染
+            if mode != 'text':
                 try:
-                    self.course_fetcher = CourseFetcher(user_info['user'], user_info['password'], "2025-02-17")
-                    result, weeks, today_reminder = await self.course_fetcher.get_courses()
-                    if result!=[]:
-                        logger.info(f"成功获取用户 {user_id} 的课程信息")
-                        output_path = 'schedule.png'
-                        await self.course_fetcher.generate_schedule_image(result, weeks, output_path)
-                        message_chain = MessageChain().file_image(output_path)
-                        await self.context.send_message(user_info['umo'], message_chain)
-                        for reminder in today_reminder:
-                            reminder_time_str = reminder['reminder_time']
-                            hour, minute = map(int, reminder_time_str.split(':'))
-                            now = datetime.now()
-                            current_time = now.time()
-                            reminder_time = datetime(now.year, now.month, now.day, hour, minute).time()
-                            if reminder_time >= current_time:
-                                job_id = f"reminder_{user_id}_{reminder_time_str}"
-                                self.scheduler.add_job(
-                                    self.send_reminder,
-                                    CronTrigger(hour=hour, minute=minute, second=0),
-                                    id=job_id,
-                                    name=f"课程提醒: {reminder_time_str}",
-                                    args=[user_id, user_info, job_id, reminder['reminder']]
-                                )
-                                logger.info(f"创建定时任务{job_id}成功")
-                            else:
-                                logger.info(f"提醒时间 {reminder_time_str} 已经过，跳过创建定时任务")
-                    else:
-                        message_chain = MessageChain().message(f"未获取到{user_id}课程信息")
-                        await self.context.send_message(user_info['umo'], message_chain)
-                        logger.info(f"未获取到{user_id}课程信息")
+                    png = await self.run_stage(
+                        limits, 'render', self.DAILY_RENDER_TIMEOUT,
+                        course_fetcher.generate_schedule_image(courses, weeks))
                 except Exception as e:
-                    logger.error(f"发送课表给用户 {user_id} 失败: {e}")
-                    self.user[user_id]["status"] = "0"
-                    self.save_user_config()
-                    message_chain = MessageChain().message(f"获取{user_id}课程信息失败已自动关闭订阅")
-                    await self.context.send_message(user_info['umo'], message_chain)
-                    logger.info(f"获取{user_id}课程信息失败")
+                    # 浏览器或驱动故障不是用户的问题，改为发送文字课表
+                    logger.error(f"渲染用户 {user_id} 的课表图片失败，改为发送文字: {e!r}")
+            if mode != 'image' or png is None:
+                with metrics.stage("render_text"):
+                    text = courses_to_text(courses)
+        return {
+            'date': datetime.now().date(),
+            'user': user_info['user'],
+            'mode': mode,
+            'weeks': weeks,
+            'courses': courses,
+            'reminders': reminders,
+            'png': png,
+            'text': text,
+        }
+
+    def delivery_mode(self, user_info):
+        """
+        用户的课表推送模式
+        :param user_info: 用户信息
+        :return: image / text / both
+        """
+        mode = user_info.get('mode') or self.DEFAULT_DELIVERY_MODE
+        if mode != 'text' and not self.images_available():
+            return 'text'
+        return mode
+
+    def images_available(self):
+        """
+        能否生成可读的课表图片，不能时所有推送改为文字
+        :return: 是否可用
+        """
+        if self._images_available is None:
+            self._images_available = CourseFetcher.resolve_render_backend(self.RENDER_BACKEND) is not None
+            if not self._images_available:
+                logger.error("未找到 msedgedriver 和中文字体，课表图片中的中文将无法显示，已改为以文字推送；"
+                             "请安装中文字体或设置 COURSE_FONT_PATH")
+        return self._images_available
+
+    def course_message(self, prepared):
+        """
+        按推送模式组装课表消息
+        :param prepared: 准备好的课表
+        :return: 消息链
+        """
+        message_chain = MessageChain()
+        if prepared['png'] is not None:
+            # 图片直接以内存中的 PNG 数据发送，并发渲染互不影响
+            message_chain.base64_image(base64.b64encode(prepared['png']).decode('ascii'))
+        if prepared['text'] is not None:
+            message_chain.message(prepared['text'])
+        return message_chain
+
+    async def run_stage(self, limits, stage, timeout, coro):
+        """
+        在指定阶段的并发限制和超时内执行协程
+        :param limits: 各阶段的信号量
+        :param stage: 阶段名称
+        :param timeout: 超时时间（秒）
+        :param coro: 要执行的协程
+        :return: 协程的返回值
+        """
+        async with limits[stage]:
+            return await asyncio.wait_for(coro, timeout=timeout)
+
+    async def send_daily_course_to_user(self, user_id, user_info, limits):
+        """
+        为单个用户执行 获取 -> 渲染 -> 发送 流程，已预取的用户直接发送
+        :param user_id: 用户ID
+        :param user_info: 用户信息
+        :param limits: 各阶段的信号量
+        """
+        started = time.perf_counter()
+        error = True
+        try:
+            await self._send_daily_course_to_user(user_id, user_info, limits)
+            error = False
+        finally:
+            metrics.observe("daily_user", time.perf_counter() - started, error=error)
+
+    async def _send_daily_course_to_user(self, user_id, user_info, limits):
+        try:
+            prepared = self.prepared.pop(user_id, None)
+            if (prepared is None or prepared['date'] != datetime.now().date() or prepared['user'] != user_info['user']
+                    or prepared['mode'] != self.delivery_mode(user_info)):
+                prepared = await self.prepare_daily_course(user_id, user_info, limits)
+            else:
+                logger.info(f"用户 {user_id} 的课表已预先准备，直接发送")
+        except asyncio.CancelledError:
+            raise
+        except (UpstreamError, asyncio.TimeoutError) as e:
+            # 教务系统故障不是用户的问题，不关闭订阅
+            logger.error(f"教务系统不可用，未能发送课表给用户 {user_id}: {e!r}")
+            message_chain = MessageChain().message("教务系统暂时不可用，今日课表获取失败，请稍后使用 /课程 查询")
+            await self.send_message(user_info['umo'], message_chain)
+            return
+        except LoginFailed as e:
+            # 只有账号或密码错误才关闭订阅
+            logger.error(f"获取用户 {user_id} 的课表失败: {e!r}")
+            self.user[user_id]["status"] = "0"
+            self.save_user_config(user_id)
+            self.audit_log.write("auto_off", user_id=user_id, account=user_info['user'], error=repr(e))
+            message_chain = MessageChain().message(f"获取{user_id}课程信息失败已自动关闭订阅")
+            await self.send_message(user_info['umo'], message_chain)
+            logger.info(f"获取{user_id}课程信息失败")
+            return
         except Exception as e:
-            logger.error(f"获取课程信息失败: {e}")
+            logger.error(f"获取用户 {user_id} 的课表失败，保留订阅: {e!r}")
+            message_chain = MessageChain().message("今日课表获取失败，请稍后使用 /课程 查询")
+            await self.send_message(user_info['umo'], message_chain)
+            return
+        # 发送失败由出站队列重试和单独统计，不影响订阅状态
+        result, today_reminder = prepared['courses'], prepared['reminders']
+        if result!=[]:
+            logger.info(f"成功获取用户 {user_id} 的课程信息")
+            if not await self.send_message(user_info['umo'], self.course_message(prepared)):
+                logger.error(f"用户 {user_id} 的今日课表发送失败")
+            added = 0
+            now = datetime.now()
+            for reminder in today_reminder:
+                reminder_time_str = reminder['reminder_time']
+                hour, minute = map(int, reminder_time_str.split(':'))
+                slot = datetime(now.year, now.month, now.day, hour, minute)
+                if slot >= now:
+                    added += self.schedule_reminder(user_id, user_info['umo'], slot, reminder['reminder'])
+                else:
+                    logger.info(f"提醒时间 {reminder_time_str} 已经过，跳过创建提醒")
+            logger.info(f"为用户 {user_id} 加入 {added} 条课程提醒")
+        else:
+            message_chain = MessageChain().message(f"未获取到{user_id}课程信息")
+            await self.send_message(user_info['umo'], message_chain)
+            logger.info(f"未获取到{user_id}课程信息")
 
     @filter.on_decorating_result()
     async def on_decorating_result(self, event: AstrMessageEvent):
@@ -552,12 +3161,120 @@ class CourseQueryPlugin(Star):
         logger.info("查询课表指令触发")
         user_id = event.get_sender_id()
         if user_id not in self.user:
-            logger.warning(f"用户 {user_id} 未在 user.ini 中注册")
+            logger.warning(f"用户 {user_id} 尚未注册")
+            yield event.plain_result("您尚未注册订阅，请先执行 /注册订阅 命令。")
+            return
+        user_info = self.user[user_id]
+        self.course_fetcher = self.new_fetcher(user_info)
+        try:
+            result, weeks, today_reminder = await self.course_fetcher.get_courses()
+        except Exception as e:
+            logger.error(f"获取课表失败: {e}")
+            yield event.plain_result("获取课表失败")
+            return
+        result = await self.course_fetcher.json_to_markdown(result)
+        yield event.plain_result(result)
+
+    @filter.command("明日课程")
+    async def query_tomorrow_course(self, event: AstrMessageEvent):
+        """
+        查询明日课程，与今日课程共用一次整周解析
+        :param event: 事件
+        """
+        user_id = event.get_sender_id()
+        if user_id not in self.user:
+            yield event.plain_result("您尚未注册订阅，请先执行 /注册订阅 命令。")
+            return
+        self.course_fetcher = self.new_fetcher(self.user[user_id])
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        try:
+            week = await self.course_fetcher.get_week_timetable(date=tomorrow)
+        except Exception as e:
+            logger.error(f"获取课表失败: {e}")
+            yield event.plain_result("获取课表失败")
+            return
+        weeks, courses, _ = self.course_fetcher.select_day(week, tomorrow.isoweekday())
+        if not courses:
+            yield event.plain_result("明天没有课程")
+            return
+        result = await self.course_fetcher.json_to_markdown(courses)
+        yield event.plain_result(f"第 {weeks}周 周{self.course_fetcher.num_map.get(tomorrow.isoweekday())}课程表\n{result}")
+
+    @filter.command("本周课程")
+    async def query_week_course(self, event: AstrMessageEvent):
+        """
+        查询本周全部课程
+        :param event: 事件
+        """
+        user_id = event.get_sender_id()
+        if user_id not in self.user:
+            yield event.plain_result("您尚未注册订阅，请先执行 /注册订阅 命令。")
+            return
+        self.course_fetcher = self.new_fetcher(self.user[user_id])
+        try:
+            week = await self.course_fetcher.get_week_timetable()
+        except Exception as e:
+            logger.error(f"获取课表失败: {e}")
+            yield event.plain_result("获取课表失败")
+            return
+        if not week.courses:
+            yield event.plain_result("本周没有课程")
+            return
+        parts = [f"第 {week.weeks}周课程表"]
+        for day in week.days():
+            parts.append(f"周{self.course_fetcher.num_map.get(day)}")
+            parts.append(await self.course_fetcher.json_to_markdown(week.on_day(day)))
+        yield event.plain_result("\n".join(parts))
+
+    @filter.command("下节课")
+    async def query_next_course(self, event: AstrMessageEvent):
+        """
+        查询今天的下一节课和剩余的空闲时段
+        :param event: 事件
+        """
+        user_id = event.get_sender_id()
+        if user_id not in self.user:
+            yield event.plain_result("您尚未注册订阅，请先执行 /注册订阅 命令。")
+            return
+        self.course_fetcher = self.new_fetcher(self.user[user_id])
+        try:
+            week = await self.course_fetcher.get_week_timetable()
+        except Exception as e:
+            logger.error(f"获取课表失败: {e}")
+            yield event.plain_result("获取课表失败")
+            return
+        now = datetime.now()
+        today = now.isoweekday()
+        course = week.next_course(today, now.time())
+        if course is None:
+            lines = ["今天没有课了"]
+        else:
+            lines = [f"下节课：{course.time_slot} {course.course_name}",
+                     f"地点：{course.location}  教师：{course.teacher}"]
+        free = week.free_slots(today)
+        if free:
+            lines.append(f"今天没有课的时段：{'、'.join(free)}")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("刷新课表")
+    async def refresh_course(self, event: AstrMessageEvent):
+        """
+        跳过缓存重新从教务系统获取课表，用于课表临时调整后
+        :param event: 事件
+        """
+        user_id = event.get_sender_id()
+        if user_id not in self.user:
             yield event.plain_result("您尚未注册订阅，请先执行 /注册订阅 命令。")
             return
         user_info = self.user[user_id]
-        self.course_fetcher = CourseFetcher(user_info['user'], user_info['password'], "2025-02-17")
-        result, weeks, today_reminder = await self.course_fetcher.get_courses()
+        self.timetable_cache.invalidate(user_info['user'])
+        self.course_fetcher = self.new_fetcher(user_info)
+        try:
+            result, weeks, today_reminder = await self.course_fetcher.get_courses(force_refresh=True)
+        except Exception as e:
+            logger.error(f"获取课表失败: {e}")
+            yield event.plain_result("获取课表失败")
+            return
         result = await self.course_fetcher.json_to_markdown(result)
         yield event.plain_result(result)
 
@@ -588,26 +3305,38 @@ class CourseQueryPlugin(Star):
                 'user': user,
                 'password': password,
                 "status" : "1",
+                'mode': self.DEFAULT_DELIVERY_MODE,
+                'campus': '',
             }
-            self.save_user_config()
-            logger.info(f"新增开启提醒的用户: {user_id}, User: {user}, Password: {password}, Platform: {platform}")
+            self.save_user_config(user_id)
+            logger.info(f"新增开启提醒的用户: {user_id}, User: {user}, Platform: {platform}")
+            self.audit_log.write("register", user_id=user_id, account=user, platform=platform)
             message_chain = MessageChain().message("已注册每日课程提醒！")
-            await self.context.send_message(self.user[user_id]['umo'], message_chain)
+            await self.send_message(self.user[user_id]['umo'], message_chain)
         else:
-            del self.user[user_id]
-            self.save_user_config()
-            logger.info(f"删除并重建用户: {user_id}")
-            # 重新创建用户信息
+            logger.info(f"重建用户: {user_id}")
+            # 账号可能已更换，旧的课表快照不再作为变动检测的基准
+            self.snapshots.pop(user_id, None)
+            self.user_store.delete_snapshot(user_id)
+            previous_username = self.user[user_id]['user']
+            previous_password = self.user[user_id]['password']
+            # 重新创建用户信息，单行覆盖写入，保留原有的推送模式
             self.user[user_id] = {
                 'platform': platform,
                 'umo': umo,
                 'user': user,
                 'password': password,
                 "status": "1",
+                'mode': self.user[user_id].get('mode') or self.DEFAULT_DELIVERY_MODE,
+                'campus': self.user[user_id].get('campus', ''),
             }
-            self.save_user_config()
-            logger.info(
-                f"重建后新增开启提醒的用户: {user_id}, User: {user}, Password: {password}, Platform: {platform}")
+            self.save_user_config(user_id)
+            # 旧账号的分组信息（包括密码）不再保留，新密码也需要重新自行获取一次
+            await self.forget_account(previous_username, previous_password)
+            self.class_groups.forget(user)
+            logger.info(f"重建后新增开启提醒的用户: {user_id}, User: {user}, Platform: {platform}")
+            self.audit_log.write("rebuild", user_id=user_id, account=user, previous_account=previous_username,
+                                 platform=platform)
             yield event.plain_result("已重建用户信息。")
 
     @filter.command("注销订阅")
@@ -620,9 +3349,12 @@ class CourseQueryPlugin(Star):
         logger.info(f"接收到关闭提醒指令，用户ID: {user_id}")
 
         if user_id in self.user:
-            del self.user[user_id]
-            self.save_user_config()
+            removed = self.user.pop(user_id)
+            username = removed['user']
+            self.save_user_config(user_id)
+            await self.forget_account(username, removed['password'])
             logger.info(f"移除开启提醒的用户: {user_id}")
+            self.audit_log.write("unregister", user_id=user_id, account=username)
             yield event.plain_result("已注销每日课程提醒！")
         else:
             logger.info(f"用户不存在，无需关闭: {user_id}")
@@ -635,7 +3367,8 @@ class CourseQueryPlugin(Star):
             yield event.plain_result("未注册用户")
         else:
             self.user[user_id]["status"] = "1"
-            self.save_user_config()
+            self.save_user_config(user_id)
+            self.audit_log.write("on", user_id=user_id)
             yield event.plain_result("已开启")
     @filter.command("off")
     async def off_reminder(self, event: AstrMessageEvent):
@@ -644,7 +3377,8 @@ class CourseQueryPlugin(Star):
             yield event.plain_result("未注册用户")
         else:
             self.user[user_id]["status"] = "0"
-            self.save_user_config()
+            self.save_user_config(user_id)
+            self.audit_log.write("off", user_id=user_id)
             yield event.plain_result("已关闭")
     @filter.command("开启定时")
     async def start_scheduler_cmd(self, event: AstrMessageEvent):
@@ -652,7 +3386,7 @@ class CourseQueryPlugin(Star):
         开启定时任务
         :param event: 事件
         """
-        if not self.scheduler.get_job('daily_course_reminder'):
+        if not self.ensure_scheduler().get_job('daily_course_reminder'):
             self.start_scheduler()
         yield event.plain_result("定时任务已启动")
 
@@ -674,29 +3408,135 @@ class CourseQueryPlugin(Star):
         logger.info("查询课表指令触发")
         user_id = event.get_sender_id()
         if user_id not in self.user:
-            logger.warning(f"用户 {user_id} 未在 user.ini 中注册")
+            logger.warning(f"用户 {user_id} 尚未注册")
             yield event.plain_result("您尚未注册订阅，请先执行 /注册订阅 命令。")
             return
         user_info = self.user[user_id]
-        self.course_fetcher = CourseFetcher(user_info['user'], user_info['password'], "2025-02-17")
-        result, weeks, today_reminder = await self.course_fetcher.get_courses()
+        self.course_fetcher = self.new_fetcher(user_info)
+        try:
+            result, weeks, today_reminder = await self.course_fetcher.get_courses()
+        except Exception as e:
+            logger.error(f"获取课表失败: {e}")
+            yield event.plain_result("获取课表失败")
+            return
         if result == []:
             yield event.plain_result("未获取到课程信息")
-        else:
-            output_path = 'schedule.png'
-            await self.course_fetcher.generate_schedule_image(result, weeks, "schedule.png")
-            yield event.image_result(output_path)
+            return
+        # 按用户的推送模式回复，文字模式不渲染图片
+        mode = self.delivery_mode(user_info)
+        chain = []
+        if mode != 'text':
+            png = await self.course_fetcher.generate_schedule_image(result, weeks)
+            chain.append(Image.fromBytes(png))
+        if mode != 'image':
+            chain.append(Plain(courses_to_text(result)))
+        yield event.chain_result(chain)
+
+    @filter.command("推送模式")
+    async def set_delivery_mode(self, event: AstrMessageEvent, mode: str = ""):
+        """
+        设置课表推送模式
+        :param event: 事件
+        :param mode: 图片 / 文字 / 全部
+        """
+        user_id = event.get_sender_id()
+        if user_id not in self.user:
+            yield event.plain_result("未注册用户")
+            return
+        current = self.DELIVERY_MODE_NAMES[self.delivery_mode(self.user[user_id])]
+        if not mode:
+            yield event.plain_result(f"当前推送模式：{current}，可选 图片 / 文字 / 全部，例如 /推送模式 文字")
+            return
+        new_mode = self.DELIVERY_MODES.get(mode.strip().lower())
+        if new_mode is None:
+            yield event.plain_result("推送模式可选 图片 / 文字 / 全部")
+            return
+        self.user[user_id]['mode'] = new_mode
+        self.save_user_config(user_id)
+        logger.info(f"用户 {user_id} 的推送模式改为 {new_mode}")
+        self.audit_log.write("mode", user_id=user_id, mode=new_mode)
+        result = f"推送模式已设置为：{self.DELIVERY_MODE_NAMES[new_mode]}"
+        if self.delivery_mode(self.user[user_id]) != new_mode:
+            result += "（当前无法生成课表图片，暂以文字推送）"
+        yield event.plain_result(result)
+
+    @filter.command("校区")
+    async def set_campus(self, event: AstrMessageEvent, campus: str = ""):
+        """
+        设置所在校区，不同校区的作息时间可能不同
+        :param event: 事件
+        :param campus: 校区名称
+        """
+        user_id = event.get_sender_id()
+        if user_id not in self.user:
+            yield event.plain_result("未注册用户")
+            return
+        campuses = self.terms.campuses()
+        current = self.user[user_id].get('campus') or self.terms.default_campus
+        if not campus:
+            yield event.plain_result(f"当前校区：{current}，可选 {' / '.join(campuses)}")
+            return
+        campus = campus.strip()
+        if campus not in campuses:
+            yield event.plain_result(f"校区可选 {' / '.join(campuses)}")
+            return
+        self.user[user_id]['campus'] = campus
+        self.save_user_config(user_id)
+        logger.info(f"用户 {user_id} 的校区改为 {campus}")
+        self.audit_log.write("campus", user_id=user_id, campus=campus)
+        yield event.plain_result(f"校区已设置为：{campus}")
 
     @filter.command("查看任务")
     async def look(self, event: AstrMessageEvent):
-        jobs = self.scheduler.get_jobs()
+        jobs = self.ensure_scheduler().get_jobs()
         logger.info(f"当前调度器内的任务数量：{len(jobs)}")
         result=""
         for job in jobs:
+            if job.id.startswith("reminder_slot_"):
+                continue
             result += f"任务ID：{job.id}\n"
-            logger.info(f"任务ID：{job.id}, 任务名称：{job.name}, 下次运行时间：{job.next_run_time}")
+        # 提醒按时段汇总，不逐条列出
+        for slot in sorted(self.reminder_slots):
+            result += f"课程提醒 {slot:%m-%d %H:%M}：{len(self.reminder_slots[slot])} 条\n"
         yield event.plain_result(result)
 
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("性能统计")
+    async def metrics_summary(self, event: AstrMessageEvent):
+        """
+        查看各阶段耗时统计
+        :param event: 事件
+        """
+        lines = [metrics.summary()]
+        lines.append(f"课表缓存: 命中 {self.timetable_cache.hits} 未命中 {self.timetable_cache.misses}")
+        lines.append(f"图片缓存: 命中 {self.render_cache.hits} 未命中 {self.render_cache.misses}")
+        lines.append(f"登录次数: {self.session_manager.login_count} 合并请求: {self.single_flight.shared}")
+        groups, members = self.class_groups.stats()
+        lines.append(f"班级分组: {groups} 组 {members} 个账号，代为获取 {self.class_groups.shared} 次")
+        lines.append(f"熔断器: {self.session_manager.breaker.state}")
+        for platform, (queued, delivered, failed) in self.delivery_queue.stats().items():
+            lines.append(f"消息发送 {platform}: 排队 {queued} 送达 {delivered} 失败 {failed}")
+        lines.append(f"消息重试: {self.delivery_queue.retried}")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("metrics")
+    async def metrics_prometheus(self, event: AstrMessageEvent):
+        """
+        以 Prometheus 文本格式输出各阶段耗时统计
+        :param event: 事件
+        """
+        yield event.plain_result(metrics.prometheus())
+
+    def dump_metrics(self):
+        """
+        将统计数据以 Prometheus 文本格式写入文件，供 node_exporter textfile 采集
+        """
+        temp_path = f"{self.METRICS_DUMP_PATH}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(metrics.prometheus())
+        os.replace(temp_path, self.METRICS_DUMP_PATH)
+
     @filter.command("ce")
     async def ce(self,event: AstrMessageEvent):
         await self.send_daily_course()
@@ -713,13 +3553,12 @@ class CourseQueryPlugin(Star):
     async def feedback(self, event: AstrMessageEvent, arg: str ):
         """处理用户反馈"""
         user_id = event.get_sender_id()
-        feedback_content = arg
-        # 在这里可以添加将反馈内容保存到文件、数据库或其他处理逻辑
+        feedback_content = arg[:self.FEEDBACK_MAX_CHARS]
         try:
-            # 示例：将反馈内容保存到文件
-            with open("feedback.txt", "a", encoding="utf-8") as f:
-                f.write(f"User: {user_id}\nFeedback: {feedback_content}\n{'-' * 50}\n")
-            logger.info(f"Received feedback from user {user_id}: {feedback_content}")
+            # 只放入缓冲，由后台协程成批写入 feedback.jsonl
+            self.feedback_log.write("feedback", user_id=user_id, platform=event.get_platform_name(),
+                                    content=feedback_content)
+            logger.info(f"Received feedback from user {user_id}, {len(feedback_content)} chars")
             yield event.plain_result("不怎么感谢您的反馈！我不会认真考虑您的建议。")
         except Exception as e:
             logger.error(f"Failed to save feedback: {e}")